@@ -6,6 +6,7 @@ import click
 import gevent
 import logging
 import pymysql
+import rfc3339
 import time
 import sys
 import up
@@ -13,14 +14,25 @@ import up
 from datetime import timedelta
 from DBUtils.PooledDB import PooledDB
 from gevent.pool import Pool
+from gevent.threadpool import ThreadPool
 from pymysql import Connection
 
 from utils import log_exceptions, nice_shutdown
+from utils.compression import wsgi_compression_middleware
 from utils.logging import configure_logging, wsgi_log_middleware
 
 from up import construct_app, run_worker, td_format
-from up.dao import UpDao, create_db
+from up.client import build_session
+from up.dao import Job, UpDao, create_db
+from up.misc import generate_id, generate_sortable_id, generate_worker_id
+from up.notify import Notifier, TokenManager, run_dispatcher
+from up.purge import purge_jobs
+from up.assets import AssetStore
+from up.render import Renderer
+from up.resolver import DnsCache, install_dns_cache
+from up.probe import ProbeCache, Prober
 from up.session import TokenDecoder
+from up.wakeup import WorkerWaker
 
 CONTEXT_SETTINGS = {
     'help_option_names': ['-h', '--help']
@@ -28,11 +40,57 @@ CONTEXT_SETTINGS = {
 
 log = logging.getLogger(__name__)
 
+# The token and send endpoints of the OpenID Connect provider may be on different hosts.
+OIDC_POOL_HOSTS = 2
+
 # Use an unbounded pool to track gevent greenlets so we can
 # wait for them to finish on shutdown.
 gevent_pool = Pool()
 
 
+def build_prober(options):
+    if options['dns_cache_size']:
+        install_dns_cache(DnsCache(max_size=options['dns_cache_size'],
+                                   max_ttl_s=options['dns_max_ttl_seconds'],
+                                   fallback_ttl_s=options['dns_fallback_ttl_seconds'],
+                                   negative_ttl_s=options['dns_negative_ttl_seconds']))
+
+    session = build_session(pool_hosts=options['probe_pool_hosts'],
+                            pool_size=options['probe_pool_size'])
+    prober = Prober(connect_timeout_s=options['connect_timeout_seconds'],
+                    read_timeout_s=options['timeout_seconds'],
+                    max_redirects=options['max_redirects'],
+                    max_body_bytes=options['max_body_bytes'],
+                    session=session,
+                    redirect_cache_size=options['redirect_cache_size'])
+
+    if options['probe_cache_ttl_seconds']:
+        prober = ProbeCache(prober,
+                            ttl_s=options['probe_cache_ttl_seconds'],
+                            max_size=options['probe_cache_size'])
+
+    return prober
+
+
+def build_oidc_session(options):
+    # Use a separate session to the prober, so connections to the OpenID Connect provider aren't
+    # pushed out of the pool by connections to the many hosts being tried.
+    return build_session(pool_hosts=OIDC_POOL_HOSTS,
+                         pool_size=options['oidc_pool_size'],
+                         pool_block=True)
+
+
+def build_notifier(options):
+    oidc_session = build_oidc_session(options)
+    token_manager = TokenManager(oidc_session,
+                                 oidc_token_endpoint=options['oidc_token_endpoint'],
+                                 oidc_client_id=options['oidc_client_id'],
+                                 oidc_client_secret=options['oidc_client_secret'],
+                                 scope='client:send')
+    return Notifier(oidc_session, token_manager,
+                    oidc_send_endpoint=options['oidc_send_endpoint'])
+
+
 @click.group(context_settings=CONTEXT_SETTINGS)
 def main():
     pass
@@ -49,6 +107,9 @@ def main():
               help='MySQL server password (default=None).')
 @click.option('--mysql-database', default='up',
               help='MySQL server database (default=up).')
+@click.option('--partition-archive', default=False, is_flag=True,
+              help='Partition the job archive table by month, so old archived jobs can be '
+                   'dropped quickly. Only applies when the table is first created.')
 @click.option('--json', '-j', default=False, is_flag=True,
               help='Log in json.')
 @click.option('--verbose', '-v', default=False, is_flag=True,
@@ -84,6 +145,58 @@ def init(**options):
     up_dao = UpDao(connection_pool)
 
     up_dao.create_job_table()
+    up_dao.create_outbox_table()
+    up_dao.create_job_attempt_table()
+    up_dao.create_job_archive_table(partitioned=options['partition_archive'])
+
+
+@click.command()
+@click.option('--rows', default=100000, type=click.IntRange(min=1),
+              help='Number of jobs to insert with each kind of ID. Use enough that the table '
+                   'outgrows the buffer pool to see the effect of random IDs (default=100000).')
+@click.option('--batch-size', default=100, type=click.IntRange(min=1),
+              help='Number of jobs to insert per transaction (default=100).')
+@click.option('--mysql-host', default='localhost',
+              help='MySQL server host (default=localhost).')
+@click.option('--mysql-port', default=3306,
+              help='MySQL server port (default=3306).')
+@click.option('--mysql-user', default='up',
+              help='MySQL server user (default=up).')
+@click.option('--mysql-password', default='',
+              help='MySQL server password (default=None).')
+@click.option('--mysql-database', default='up',
+              help='MySQL server database (default=up).')
+def bench_job_ids(**options):
+    """Compare job insert throughput with random and time sortable job IDs."""
+
+    connection_pool = PooledDB(creator=pymysql,
+                               mincached=1,
+                               maxcached=1,
+                               # max connections currently in use - doesn't
+                               # include cached connections
+                               maxconnections=1,
+                               blocking=True,
+                               host=options['mysql_host'],
+                               port=options['mysql_port'],
+                               user=options['mysql_user'],
+                               password=options['mysql_password'],
+                               database=options['mysql_database'],
+                               charset='utf8mb4',
+                               cursorclass=pymysql.cursors.DictCursor)
+    up_dao = UpDao(connection_pool)
+
+    for name, generate_job_id in (('random', generate_id), ('sortable', generate_sortable_id)):
+        jobs = [Job(job_id=generate_job_id(),
+                    user_id='bench',
+                    status='pending',
+                    run_dt=rfc3339.now(),
+                    url=f'https://example.com/{i}',
+                    tries=9,
+                    delay_s=900)
+                for i in range(options['rows'])]
+
+        elapsed_s = up_dao.bench_insert_jobs(jobs, batch_size=options['batch_size'])
+        print(f'{name:>8}: {len(jobs) / elapsed_s:10.0f} inserts/s ({elapsed_s:.1f}s)')
 
 
 @click.command()
@@ -91,8 +204,57 @@ def init(**options):
               help='Number of times to try a URL (default=9).')
 @click.option('--initial-delay-minutes', default=15,
               help='How long to wait before the first try of a URL (default=15).')
+@click.option('--connect-timeout-seconds', default=5,
+              help='Connection timeout when trying a URL (default=5).')
 @click.option('--timeout-seconds', default=10,
-              help='Timeout when trying a URL (default=10).')
+              help='Read timeout when trying a URL (default=10).')
+@click.option('--max-redirects', default=10,
+              help='Maximum number of redirects to follow when trying a URL (default=10).')
+@click.option('--max-body-bytes', default=0,
+              help='Maximum number of response body bytes to read when trying a URL. '
+                   'Usually only the status is needed. (default=0)')
+@click.option('--redirect-cache-size', default=10000, type=click.IntRange(min=0),
+              help='Number of permanent redirects to remember, so they can be skipped when '
+                   'trying a URL again. (default=10000, 0 disables)')
+@click.option('--probe-pool-hosts', default=100,
+              help='Number of hosts to keep connections open to for trying URLs (default=100).')
+@click.option('--probe-pool-size', default=2,
+              help='Number of connections to keep open per host for trying URLs (default=2).')
+@click.option('--probe-cache-ttl-seconds', default=30, type=click.IntRange(min=0),
+              help='How long to cache the result of trying a URL. (default=30, 0 disables)')
+@click.option('--probe-cache-size', default=10000, type=click.IntRange(min=1),
+              help='Maximum number of URL results to cache (default=10000).')
+@click.option('--dns-cache-size', default=10000, type=click.IntRange(min=0),
+              help='Maximum number of hostname lookups to cache. (default=10000, 0 disables)')
+@click.option('--dns-max-ttl-seconds', default=3600, type=click.IntRange(min=0),
+              help='Maximum time to cache a hostname lookup, whatever its TTL (default=3600).')
+@click.option('--dns-fallback-ttl-seconds', default=60, type=click.IntRange(min=0),
+              help='How long to cache hostname lookups made without TTLs, via the system resolver '
+                   '(default=60).')
+@click.option('--dns-negative-ttl-seconds', default=30, type=click.IntRange(min=0),
+              help='How long to cache failed hostname lookups (default=30).')
+@click.option('--oidc-pool-size', default=10,
+              help='Maximum number of connections to the OpenID Connect provider (default=10).')
+@click.option('--session-cache-size', default=10000, type=click.IntRange(min=0),
+              help='Number of verified session tokens to cache, to avoid verifying their '
+                   'signatures on every request. (default=10000, 0 disables)')
+@click.option('--crypto-threads', default=2, type=click.IntRange(min=0),
+              help='Number of threads to verify token signatures in, off the main event loop. '
+                   '(default=2, 0 verifies on the event loop)')
+@click.option('--render-threads', default=0, type=click.IntRange(min=0),
+              help='Number of threads to render pages in, off the main event loop. '
+                   '(default=0, renders on the event loop)')
+@click.option('--render-cache-size', default=100, type=click.IntRange(min=0),
+              help='Number of rendered pages that don\'t depend on the session, like the logged '
+                   'out index page and error pages, to cache. (default=100, 0 disables)')
+@click.option('--compress/--no-compress', default=True,
+              help='Compress responses for clients that accept it. (default=enabled)')
+@click.option('--compress-min-size', default=1024, type=click.IntRange(min=0),
+              help='Minimum size of response to compress, in bytes (default=1024).')
+@click.option('--bulk-check-concurrency', default=10, type=click.IntRange(min=1),
+              help='Number of URLs to check at once for each bulk check request (default=10).')
+@click.option('--bulk-check-max-urls', default=50, type=click.IntRange(min=1),
+              help='Maximum number of URLs to check in a bulk check request (default=50).')
 @click.option('--service-protocol', type=click.Choice(('https', 'http')),
               default='https',
               help='The protocol for the public service. (default=https)')
@@ -130,6 +292,9 @@ def init(**options):
               help='MySQL server password (default=None).')
 @click.option('--mysql-database', default='up',
               help='MySQL server database (default=up).')
+@click.option('--worker-wakeup-address', multiple=True,
+              help='Address of a worker to wake when a job is added, as host:port. '
+                   'May be given multiple times.')
 @click.option('--testing-mode', default=False, is_flag=True,
               help='Relax security to simplify testing, e.g. allow http cookies')
 @click.option('--port', '-p', default=8080,
@@ -186,9 +351,29 @@ def server(**options):
 
     with options['oidc_public_key_file'] as file:
         public_key = file.read()
-    token_decoder = TokenDecoder(public_key, options['oidc_iss'], options['oidc_client_id'])
-
-    app = construct_app(up_dao, token_decoder, **options)
+    # Run CPU heavy work in native threads, so it doesn't block other requests on the hub.
+    crypto_threadpool = None
+    if options['crypto_threads']:
+        crypto_threadpool = ThreadPool(options['crypto_threads'])
+    token_decoder = TokenDecoder(public_key, options['oidc_iss'], options['oidc_client_id'],
+                                 cache_size=options['session_cache_size'],
+                                 threadpool=crypto_threadpool)
+
+    render_threadpool = None
+    if options['render_threads']:
+        render_threadpool = ThreadPool(options['render_threads'])
+    assets = AssetStore()
+    renderer = Renderer(threadpool=render_threadpool, cache_size=options['render_cache_size'],
+                        defaults={'asset_url': assets.url})
+
+    prober = build_prober(options)
+    oidc_session = build_oidc_session(options)
+    worker_waker = WorkerWaker(options['worker_wakeup_address'])
+
+    app = construct_app(up_dao, token_decoder, prober, oidc_session, worker_waker, renderer, assets,
+                        **options)
+    if options['compress']:
+        app = wsgi_compression_middleware(app, min_size=options['compress_min_size'])
     app = wsgi_log_middleware(app)
 
     with nice_shutdown(shutdown):
@@ -202,8 +387,105 @@ def server(**options):
 @click.command()
 @click.option('--delay-multiplier', default=2,
               help='Multiplier to apply to the delay after each try of a URL (default=2).')
+@click.option('--connect-timeout-seconds', default=5,
+              help='Connection timeout when trying a URL (default=5).')
 @click.option('--timeout-seconds', default=10,
-              help='Timeout when trying a URL (default=10).')
+              help='Read timeout when trying a URL (default=10).')
+@click.option('--max-redirects', default=10,
+              help='Maximum number of redirects to follow when trying a URL (default=10).')
+@click.option('--max-body-bytes', default=0,
+              help='Maximum number of response body bytes to read when trying a URL. '
+                   'Usually only the status is needed. (default=0)')
+@click.option('--redirect-cache-size', default=10000, type=click.IntRange(min=0),
+              help='Number of permanent redirects to remember, so they can be skipped when '
+                   'trying a URL again. (default=10000, 0 disables)')
+@click.option('--probe-pool-hosts', default=100,
+              help='Number of hosts to keep connections open to for trying URLs (default=100).')
+@click.option('--probe-pool-size', default=2,
+              help='Number of connections to keep open per host for trying URLs (default=2).')
+@click.option('--probe-cache-ttl-seconds', default=30, type=click.IntRange(min=0),
+              help='How long to cache the result of trying a URL. (default=30, 0 disables)')
+@click.option('--probe-cache-size', default=10000, type=click.IntRange(min=1),
+              help='Maximum number of URL results to cache (default=10000).')
+@click.option('--dns-cache-size', default=10000, type=click.IntRange(min=0),
+              help='Maximum number of hostname lookups to cache. (default=10000, 0 disables)')
+@click.option('--dns-max-ttl-seconds', default=3600, type=click.IntRange(min=0),
+              help='Maximum time to cache a hostname lookup, whatever its TTL (default=3600).')
+@click.option('--dns-fallback-ttl-seconds', default=60, type=click.IntRange(min=0),
+              help='How long to cache hostname lookups made without TTLs, via the system resolver '
+                   '(default=60).')
+@click.option('--dns-negative-ttl-seconds', default=30, type=click.IntRange(min=0),
+              help='How long to cache failed hostname lookups (default=30).')
+@click.option('--oidc-pool-size', default=10,
+              help='Maximum number of connections to the OpenID Connect provider (default=10).')
+@click.option('--concurrency', default=10, type=click.IntRange(min=1),
+              help='Maximum number of URLs to try at once (default=10).')
+@click.option('--host-concurrency', default=2, type=click.IntRange(min=1),
+              help='Maximum number of URLs on the same host to try at once (default=2).')
+@click.option('--host-min-interval-seconds', default=1.0, type=click.FloatRange(min=0),
+              help='Minimum time between starting tries of URLs on the same host (default=1).')
+@click.option('--host-queue-size', default=1000, type=click.IntRange(min=1),
+              help='Maximum number of URLs to hold while waiting for their host to be ready '
+                   '(default=1000).')
+@click.option('--host-failure-threshold', default=3, type=click.IntRange(min=0),
+              help='Number of failed connections to a host in a row before treating it as down, '
+                   'without trying its URLs. (default=3, 0 disables)')
+@click.option('--max-retry-after-seconds', default=60 * 60 * 24, type=click.IntRange(min=0),
+              help='Maximum time to wait before trying a URL again when asked to by a '
+                   'Retry-After header (default=86400).')
+@click.option('--host-open-seconds', default=60, type=click.IntRange(min=1),
+              help='How long to treat a host as down before checking it can be connected to '
+                   'again (default=60).')
+@click.option('--worker-id', default='',
+              help='Unique ID for this worker, used when claiming jobs. '
+                   '(default=generated from the hostname and process ID)')
+@click.option('--lease-seconds', default=300, type=click.IntRange(min=1),
+              help='How long a claimed job is reserved for this worker. If the job isn\'t '
+                   'finished by then, another worker may claim it. (default=300)')
+@click.option('--batch-size', default=100, type=click.IntRange(min=1),
+              help='Maximum number of jobs to claim, or finish, in a single database '
+                   'transaction. (default=100)')
+@click.option('--wakeup-port', default=0,
+              help='UDP port to listen on for wake ups from the server when a job is added. '
+                   '(default=0, disabled)')
+@click.option('--wakeup-host', default='127.0.0.1',
+              help='Address to listen on for wake ups. Wake ups aren\'t authenticated, so only '
+                   'listen on an interface the server can reach, but no one else can. '
+                   '(default=127.0.0.1)')
+@click.option('--idle-poll-seconds', default=300, type=click.IntRange(min=1),
+              help='How often to reload all upcoming jobs from the database, to pick up jobs '
+                   'whose lease expired and any missed wake ups. (default=300)')
+@click.option('--schedule-window-seconds', default=600, type=click.IntRange(min=1),
+              help='How far ahead to load upcoming jobs into memory. (default=600)')
+@click.option('--schedule-max-jobs', default=100000, type=click.IntRange(min=1),
+              help='Maximum number of upcoming jobs to hold in memory. (default=100000)')
+@click.option('--dispatch/--no-dispatch', default=True,
+              help='Send messages from the outbox in this worker. Disable if running separate '
+                   'dispatchers. (default=enabled)')
+@click.option('--dispatch-concurrency', default=10, type=click.IntRange(min=1),
+              help='Maximum number of messages to send at once (default=10).')
+@click.option('--dispatch-poll-seconds', default=30, type=click.IntRange(min=1),
+              help='How often to check the outbox for messages to send (default=30).')
+@click.option('--dispatch-max-attempts', default=10, type=click.IntRange(min=1),
+              help='Number of times to try sending a message before giving up (default=10).')
+@click.option('--record-attempts/--no-record-attempts', default=False,
+              help='Record every try of a job in the attempt history table, as retries '
+                   'reschedule the job in place. (default=disabled)')
+@click.option('--purge-interval-seconds', default=0, type=click.IntRange(min=0),
+              help='How often to purge done jobs in this worker. (default=0, disabled)')
+@click.option('--retention-days', default=30, type=click.IntRange(min=0),
+              help='How long to keep done jobs in the job table (default=30).')
+@click.option('--archive/--no-archive', default=True,
+              help='Move done jobs to the archive table, rather than deleting them. '
+                   '(default=enabled)')
+@click.option('--archive-retention-days', default=0, type=click.IntRange(min=0),
+              help='How long to keep archived jobs. Partitioned archives drop whole months at a '
+                   'time. (default=0, forever)')
+@click.option('--purge-chunk-size', default=1000, type=click.IntRange(min=1),
+              help='Number of jobs to move or delete per transaction (default=1000).')
+@click.option('--purge-chunk-sleep-seconds', default=0.5, type=click.FloatRange(min=0),
+              help='How long to sleep between chunks, to limit load on the database. '
+                   '(default=0.5)')
 @click.option('--oidc-token-endpoint', required=True,
               help='URL of the token endpoint of the OpenID Connect provider.')
 @click.option('--oidc-send-endpoint', required=True,
@@ -231,6 +513,133 @@ def worker(**options):
 
     configure_logging(json=options['json'], verbose=options['verbose'])
 
+    # One connection for claiming jobs, one for writing finished jobs back in batches, one for
+    # sending messages, and one for purging done jobs.
+    connection_pool = PooledDB(creator=pymysql,
+                               mincached=1,
+                               maxcached=4,
+                               # max connections currently in use - doesn't
+                               # include cached connections
+                               maxconnections=4,
+                               blocking=True,
+                               host=options['mysql_host'],
+                               port=options['mysql_port'],
+                               user=options['mysql_user'],
+                               password=options['mysql_password'],
+                               database=options['mysql_database'],
+                               charset='utf8mb4',
+                               cursorclass=pymysql.cursors.DictCursor)
+    up_dao = UpDao(connection_pool)
+
+    with nice_shutdown():
+        run_worker(up_dao, build_prober(options), build_notifier(options), **options)
+
+
+@click.command()
+@click.option('--worker-id', default='',
+              help='Unique ID for this dispatcher, used when claiming messages. '
+                   '(default=generated from the hostname and process ID)')
+@click.option('--lease-seconds', default=300, type=click.IntRange(min=1),
+              help='How long claimed messages are reserved for this dispatcher. If they aren\'t '
+                   'sent by then, another dispatcher may claim them. (default=300)')
+@click.option('--batch-size', default=100, type=click.IntRange(min=1),
+              help='Maximum number of messages to claim at once. (default=100)')
+@click.option('--dispatch-concurrency', default=10, type=click.IntRange(min=1),
+              help='Maximum number of messages to send at once (default=10).')
+@click.option('--dispatch-poll-seconds', default=5, type=click.IntRange(min=1),
+              help='How often to check the outbox for messages to send (default=5).')
+@click.option('--dispatch-max-attempts', default=10, type=click.IntRange(min=1),
+              help='Number of times to try sending a message before giving up (default=10).')
+@click.option('--oidc-pool-size', default=10,
+              help='Maximum number of connections to the OpenID Connect provider (default=10).')
+@click.option('--oidc-token-endpoint', required=True,
+              help='URL of the token endpoint of the OpenID Connect provider.')
+@click.option('--oidc-send-endpoint', required=True,
+              help='URL of the send message endpoint of the OpenID Connect provider.')
+@click.option('--oidc-client-id', required=True,
+              help='Client ID issued by the OpenID Connect provider.')
+@click.option('--oidc-client-secret', required=True,
+              help='Client secret issued by the OpenID Connect provider.')
+@click.option('--mysql-host', default='localhost',
+              help='MySQL server host (default=localhost).')
+@click.option('--mysql-port', default=3306,
+              help='MySQL server port (default=3306).')
+@click.option('--mysql-user', default='up',
+              help='MySQL server user (default=up).')
+@click.option('--mysql-password', default='',
+              help='MySQL server password (default=None).')
+@click.option('--mysql-database', default='up',
+              help='MySQL server database (default=up).')
+@click.option('--json', '-j', default=False, is_flag=True,
+              help='Log in json.')
+@click.option('--verbose', '-v', default=False, is_flag=True,
+              help='Log debug messages.')
+@log_exceptions(exit_on_exception=True)
+def dispatcher(**options):
+
+    configure_logging(json=options['json'], verbose=options['verbose'])
+
+    connection_pool = PooledDB(creator=pymysql,
+                               mincached=1,
+                               maxcached=1,
+                               # max connections currently in use - doesn't
+                               # include cached connections
+                               maxconnections=1,
+                               blocking=True,
+                               host=options['mysql_host'],
+                               port=options['mysql_port'],
+                               user=options['mysql_user'],
+                               password=options['mysql_password'],
+                               database=options['mysql_database'],
+                               charset='utf8mb4',
+                               cursorclass=pymysql.cursors.DictCursor)
+    up_dao = UpDao(connection_pool)
+
+    dispatcher_id = options['worker_id'] or generate_worker_id()
+    log.info('Starting dispatcher %(dispatcher_id)s.', {'dispatcher_id': dispatcher_id})
+
+    with nice_shutdown():
+        run_dispatcher(up_dao, build_notifier(options), dispatcher_id,
+                       concurrency=options['dispatch_concurrency'],
+                       lease_seconds=options['lease_seconds'],
+                       batch_size=options['batch_size'],
+                       poll_seconds=options['dispatch_poll_seconds'],
+                       max_attempts=options['dispatch_max_attempts'])
+
+
+@click.command()
+@click.option('--retention-days', default=30, type=click.IntRange(min=0),
+              help='How long to keep done jobs in the job table (default=30).')
+@click.option('--archive/--no-archive', default=True,
+              help='Move done jobs to the archive table, rather than deleting them. '
+                   '(default=enabled)')
+@click.option('--archive-retention-days', default=0, type=click.IntRange(min=0),
+              help='How long to keep archived jobs. Partitioned archives drop whole months at a '
+                   'time. (default=0, forever)')
+@click.option('--purge-chunk-size', default=1000, type=click.IntRange(min=1),
+              help='Number of jobs to move or delete per transaction (default=1000).')
+@click.option('--purge-chunk-sleep-seconds', default=0.5, type=click.FloatRange(min=0),
+              help='How long to sleep between chunks, to limit load on the database. '
+                   '(default=0.5)')
+@click.option('--mysql-host', default='localhost',
+              help='MySQL server host (default=localhost).')
+@click.option('--mysql-port', default=3306,
+              help='MySQL server port (default=3306).')
+@click.option('--mysql-user', default='up',
+              help='MySQL server user (default=up).')
+@click.option('--mysql-password', default='',
+              help='MySQL server password (default=None).')
+@click.option('--mysql-database', default='up',
+              help='MySQL server database (default=up).')
+@click.option('--json', '-j', default=False, is_flag=True,
+              help='Log in json.')
+@click.option('--verbose', '-v', default=False, is_flag=True,
+              help='Log debug messages.')
+@log_exceptions(exit_on_exception=True)
+def purge(**options):
+
+    configure_logging(json=options['json'], verbose=options['verbose'])
+
     connection_pool = PooledDB(creator=pymysql,
                                mincached=1,
                                maxcached=1,
@@ -248,7 +657,12 @@ def worker(**options):
     up_dao = UpDao(connection_pool)
 
     with nice_shutdown():
-        run_worker(up_dao, **options)
+        purge_jobs(up_dao,
+                   retention_days=options['retention_days'],
+                   archive=options['archive'],
+                   archive_retention_days=options['archive_retention_days'],
+                   chunk_size=options['purge_chunk_size'],
+                   chunk_sleep_seconds=options['purge_chunk_sleep_seconds'])
 
 
 @click.command()
@@ -273,7 +687,10 @@ def show_schedule(tries, initial_delay_minutes, delay_multiplier):
 main.add_command(init)
 main.add_command(server)
 main.add_command(worker)
+main.add_command(dispatcher)
+main.add_command(purge)
 main.add_command(show_schedule)
+main.add_command(bench_job_ids)
 
 
 if __name__ == '__main__':
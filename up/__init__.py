@@ -1,18 +1,30 @@
+import gevent
+import json
 import logging
 import requests
 import rfc3339
-import time
 
-from bottle import Bottle, request, response, static_file, template, redirect
+from bottle import Bottle, request, response, redirect
+from collections import defaultdict
 from datetime import timedelta
+from gevent.event import Event
+from gevent.pool import Pool
 from jwt.exceptions import InvalidTokenError
 from urllib.parse import urlparse, urljoin, urlencode
 
 from utils.param_parse import parse_params, boolean_param, string_param
 
-from .dao import Job
-from .misc import abort, html_default_error_hander, generate_id, hash_urlsafe, security_headers
+from .dao import Attempt, FinishedJob, Job, Message
+from .hosts import HostHealth, HostQueue
+from .misc import abort, build_html_error_handler, security_headers
+from .misc import generate_id, generate_sortable_id, generate_worker_id, hash_urlsafe, url_hash
+from .misc import is_http_url, url_host
+from .notify import run_dispatcher
+from .probe import ProbeError, can_connect
+from .purge import run_purger
+from .scheduler import JobSchedule
 from .session import SessionHandler
+from .wakeup import WakeupListener
 
 
 log = logging.getLogger(__name__)
@@ -33,6 +45,19 @@ NOTIFICATION_CHANNEL = 'link_notifications'
 
 SERVER_READY = True
 
+FINISHED_JOBS_FLUSH_INTERVAL_S = 1
+
+TOO_MANY_REQUESTS = 429
+
+# Tried in place of a probe result for urls that can't be probed at all, e.g. malformed ones.
+INVALID_URL = object()
+
+# Marks where streamed results go in the bulk check page, to split it into a prefix and suffix.
+BULK_CHECK_RESULTS_SENTINEL = '<!-- bulk-check-results -->'
+# The urls to notify about are kept in the OIDC data cookie during the OIDC flow, so must fit in
+# the cookie along with everything else.
+BULK_NOTIFY_MAX_URLS_LENGTH = 2500
+
 
 def td_format(td_object):
     remaining_secs = int(td_object.total_seconds())
@@ -51,8 +76,9 @@ def td_format(td_object):
         return ', '.join(strings)
 
 
-def construct_app(dao, token_decoder,
-                  tries, initial_delay_minutes, timeout_seconds,
+def construct_app(dao, token_decoder, prober, oidc_session, worker_waker, renderer, assets,
+                  tries, initial_delay_minutes,
+                  bulk_check_concurrency, bulk_check_max_urls,
                   service_protocol, service_hostname,
                   service_port, service_path,
                   oidc_name, oidc_iss, oidc_about_url,
@@ -64,7 +90,7 @@ def construct_app(dao, token_decoder,
     session_handler = SessionHandler(token_decoder, testing_mode=testing_mode)
 
     app = Bottle()
-    app.default_error_handler = html_default_error_hander
+    app.default_error_handler = build_html_error_handler(renderer)
 
     app.install(security_headers)
 
@@ -102,6 +128,51 @@ def construct_app(dao, token_decoder,
                             {'continue_url': continue_url})
                 abort(400)
 
+    def new_job(user_id, url):
+        now_dt = rfc3339.now()
+        # Job IDs sort by creation time, so new jobs are appended to the job table's primary
+        # key. Older, fully random IDs are still valid alongside them.
+        return Job(job_id=generate_sortable_id(),
+                   user_id=user_id,
+                   status='pending',
+                   run_dt=now_dt + initial_delay,
+                   url=url,
+                   tries=tries,
+                   delay_s=initial_delay.total_seconds())
+
+    def check_url(url):
+        """
+        Probe a url, returning it along with whether it's 'up', 'down', a 'client_error', or
+        'invalid' if it can't be probed at all.
+        """
+        if not is_http_url(url):
+            return url, 'invalid'
+
+        try:
+            s = prober.probe(url).status_code
+
+        except ProbeError:
+            return url, 'down'
+
+        # e.g. the url's host isn't valid, in ways urlsplit doesn't check. Some of these are raised
+        # by urllib3 as ValueErrors, rather than wrapped by requests.
+        except (requests.exceptions.RequestException, ValueError) as e:
+            log.info('[Check] Invalid url %(url)s: %(error)s', {'url': url, 'error': e})
+            return url, 'invalid'
+
+        # Too Many Requests is temporary, so the url may still be down for everyone.
+        if s >= 500 and s < 600 or s == TOO_MANY_REQUESTS:
+            return url, 'down'
+
+        if s >= 400 and s < 500:
+            return url, 'client_error'
+        elif s >= 200 and s < 300:
+            return url, 'up'
+        else:
+            log.error('[Check] Unexpected status %(status)s received for url %(url)s.',
+                      {'status': s, 'url': url})
+            return url, 'unexpected'
+
     def construct_oidc_request(*scopes, channels=None):
         state = generate_id()
         nonce = generate_id()
@@ -148,22 +219,30 @@ def construct_app(dao, token_decoder,
         else:
             user_id = None
 
-        return template('index',
-                        user_id=user_id,
-                        oidc_name=oidc_name,
-                        oidc_about_url=oidc_about_url)
+        if user_id is None:
+            # The anonymous index page is the same for everyone, so is rendered once and cached.
+            return renderer.render_cached('index',
+                                          user_id=None,
+                                          oidc_name=oidc_name,
+                                          oidc_about_url=oidc_about_url)
+
+        return renderer.render('index',
+                               user_id=user_id,
+                               oidc_name=oidc_name,
+                               oidc_about_url=oidc_about_url)
 
-    @app.get('/main.css')
-    def css():
-        return static_file('main.css', root='static')
+    # Assets are also served at hashed urls, e.g. /main.<hash>.css, which these routes all match.
+    @app.get('/<filename>.css')
+    def css(filename):
+        return assets.serve(f'{filename}.css')
 
     @app.get('/robots.txt')
     def robots():
-        return static_file('robots.txt', root='static')
+        return assets.serve('robots.txt')
 
     @app.get('/site.webmanifest')
     def manifest():
-        return static_file('site.webmanifest', root='static')
+        return assets.serve('site.webmanifest')
 
     # Set CORP to allow Firefox for Android to load icons.
     # Firefox for Android seems to consider the icon loader a different origin.
@@ -173,16 +252,16 @@ def construct_app(dao, token_decoder,
     @app.get('/favicon.ico',
              sh_updates={'Cross-Origin-Resource-Policy': 'cross-origin'})
     def icon():
-        return static_file('favicon.ico', root='static')
+        return assets.serve('favicon.ico')
 
     @app.get('/<filename>.png',
              sh_updates={'Cross-Origin-Resource-Policy': 'cross-origin'})
     def root_pngs(filename):
-        return static_file(f'{filename}.png', root='static')
+        return assets.serve(f'{filename}.png')
 
     @app.get('/<filename>.js')
     def scripts(filename):
-        return static_file(f'{filename}.js', root='static')
+        return assets.serve(f'{filename}.js')
 
     @app.get('/login')
     def get_login():
@@ -205,10 +284,10 @@ def construct_app(dao, token_decoder,
             redirect(oidc_login_uri)
 
         else:
-            return template('login',
-                            oidc_name=oidc_name,
-                            oidc_about_url=oidc_about_url,
-                            oidc_login_uri=oidc_login_uri)
+            return renderer.render('login',
+                                   oidc_name=oidc_name,
+                                   oidc_about_url=oidc_about_url,
+                                   oidc_login_uri=oidc_login_uri)
 
     @app.get('/oidc/callback')
     def get_oidc_callback():
@@ -261,6 +340,10 @@ def construct_app(dao, token_decoder,
                     qs = urlencode(qs_dict)
                     redirect(f'/link?{qs}')
 
+                elif action == 'notify_bulk':
+                    # Bulk notify OIDC request, send them back to the bulk check page.
+                    redirect('/links')
+
                 else:
                     raise NotImplementedError(f'Unsupported OIDC action {action}.')
 
@@ -284,12 +367,12 @@ def construct_app(dao, token_decoder,
             log.warning('Received OIDC callback with no code.')
             abort(500)
 
-        r = requests.post(oidc_token_endpoint, timeout=10,
-                          auth=(oidc_client_id, oidc_client_secret),
-                          data={'grant_type': 'authorization_code',
-                                'client_id': oidc_client_id,
-                                'redirect_uri': oidc_redirect_uri,
-                                'code': code})
+        r = oidc_session.post(oidc_token_endpoint, timeout=10,
+                              auth=(oidc_client_id, oidc_client_secret),
+                              data={'grant_type': 'authorization_code',
+                                    'client_id': oidc_client_id,
+                                    'redirect_uri': oidc_redirect_uri,
+                                    'code': code})
 
         # Only supported response status code.
         if r.status_code == 200:
@@ -339,18 +422,31 @@ def construct_app(dao, token_decoder,
                 qs = urlencode(qs_dict)
                 redirect(f'/link?{qs}')
 
-            now_dt = rfc3339.now()
-            job = Job(job_id=generate_id(),
-                      user_id=id_token_jwt['sub'],
-                      status='pending',
-                      run_dt=now_dt + initial_delay,
-                      url=url,
-                      tries=tries,
-                      delay_s=initial_delay.total_seconds())
-            dao.insert_job(job)
-            return template('notify_result',
-                            oidc_name=oidc_name,
-                            url=url)
+            job = new_job(id_token_jwt['sub'], url)
+            # Clicking notify again for a url that's already watched doesn't add another job.
+            dao.upsert_job(job)
+            worker_waker.wake()
+            return renderer.render('notify_result',
+                                   oidc_name=oidc_name,
+                                   url=url)
+
+        elif action == 'notify_bulk':
+            urls = oidc_data['urls']
+
+            approved_scopes = r_json['scope'].split()
+            if not ('offline_access' in approved_scopes and 'contact' in approved_scopes):
+                redirect('/links?alert=insufficient-scope')
+
+            approved_channels = r_json['channels'].split()
+            if NOTIFICATION_CHANNEL not in approved_channels:
+                redirect('/links?alert=insufficient-channels')
+
+            jobs = [new_job(id_token_jwt['sub'], url) for url in urls]
+            dao.upsert_jobs(jobs)
+            worker_waker.wake()
+            return renderer.render('notify_bulk_result',
+                                   oidc_name=oidc_name,
+                                   urls=urls)
 
         else:
             raise NotImplementedError(f'Unsupported OIDC action {action}.')
@@ -385,23 +481,17 @@ def construct_app(dao, token_decoder,
         if not url:
             abort(400, 'Please specify a url.')
 
-        try:
-            r = requests.get(url, timeout=timeout_seconds)
-            s = r.status_code
-
-        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-            return template('check_down', alert=alert, oidc_name=oidc_name, url=url, csrf=csrf)
-
-        if s >= 500 and s < 600:
-            return template('check_down', alert=alert, oidc_name=oidc_name, url=url, csrf=csrf)
+        _, status = check_url(url)
 
-        if s >= 400 and s < 500:
-            return template('check_client_error', url=url)
-        elif s >= 200 and s < 300:
-            return template('check_up', url=url)
+        if status == 'invalid':
+            abort(400, 'Please specify a valid http or https url.')
+        elif status == 'down':
+            return renderer.render('check_down', alert=alert, oidc_name=oidc_name, url=url, csrf=csrf)
+        elif status == 'client_error':
+            return renderer.render('check_client_error', url=url)
+        elif status == 'up':
+            return renderer.render('check_up', url=url)
         else:
-            log.error('[Check] Unexpected status %(status)s received for url %(url)s.',
-                      {'status': s, 'url': url})
             abort(500)
 
     @app.post('/link')
@@ -410,6 +500,8 @@ def construct_app(dao, token_decoder,
         url = request.query.url
         if not url:
             abort(400, 'Please specify a url.')
+        if not is_http_url(url):
+            abort(400, 'Please specify a valid http or https url.')
 
         state, nonce, oidc_login_uri = construct_oidc_request('openid', 'offline_access', 'contact',
                                                               channels=['link_notifications'])
@@ -420,114 +512,179 @@ def construct_app(dao, token_decoder,
 
         redirect(oidc_login_uri)
 
-    return app
-
-
-token_data = None
-
-
-def run_worker(dao, delay_multiplier, timeout_seconds,
-               oidc_token_endpoint, oidc_send_endpoint,
-               oidc_client_id, oidc_client_secret,
-               **kwargs):
-
-    def get_access_token():
-        global token_data
-
-        request_dt = rfc3339.now()
-        if token_data and request_dt < token_data['expire_dt']:
-            return token_data['access_token']
-
-        # Get a client credentials access token.
-        r = requests.post(oidc_token_endpoint, timeout=10,
-                          auth=(oidc_client_id, oidc_client_secret),
-                          data={'grant_type': 'client_credentials',
-                                'scope': 'client:send'})
-
-        if r.status_code != 200:
-            log.warning('OIDC token endpoint returned unexpected status code %(status_code)s.',
-                        {'status_code': r.status_code})
-            r.raise_for_status()
-            raise NotImplementedError(f'Unsupported status code {r.status_code}.')
-
-        r_json = r.json()
-
-        access_token = r_json['access_token']
-        expire_dt = request_dt + timedelta(seconds=r_json['expires_in'])
-        token_data = {'access_token': access_token, 'expire_dt': expire_dt}
+    @app.get('/links')
+    @session_handler.require_session()
+    def get_bulk_check():
+        # NOTE: Alerts are only for errors from the bulk notify OIDC flow.
+        return renderer.render('links',
+                               alert=request.query.alert,
+                               max_urls=bulk_check_max_urls,
+                               csrf=request.session['csrf'])
+
+    @app.post('/links', sh_csp_updates={'form-action': csp_form_action})
+    @session_handler.require_session()
+    def bulk_check():
+        csrf = request.session['csrf']
 
-        return access_token
+        params = parse_params(request.forms.decode(),
+                              urls=string_param('urls', strip=True, multi='\n', max_length=2000))
+        # Drop duplicates, keeping the order the urls were given in.
+        urls = list(dict.fromkeys(params.get('urls', [])))
+        if not urls:
+            abort(400, 'Please specify some urls.')
+        if len(urls) > bulk_check_max_urls:
+            abort(400, f'Please specify no more than {bulk_check_max_urls} urls.')
+
+        # Render the page around the results up front, so each result can be sent as soon as it's
+        # ready, rather than waiting for every url to be checked.
+        page = renderer.render('check_bulk', results=BULK_CHECK_RESULTS_SENTINEL, count=len(urls))
+        prefix, suffix = page.split(BULK_CHECK_RESULTS_SENTINEL)
+
+        def stream_results():
+            # Check urls concurrently, but only a few at a time, so one request can't swamp the
+            # prober.
+            pool = Pool(bulk_check_concurrency)
+            try:
+                yield prefix
 
-    def send_message(job_id, user_id, url, subject, message):
+                down_urls = set()
+                for url, status in pool.imap_unordered(check_url, urls):
+                    if status == 'down':
+                        down_urls.add(url)
+                    yield renderer.render('check_bulk_result', url=url, status=status)
 
-        access_token = get_access_token()
+                yield renderer.render('check_bulk_notify',
+                                      oidc_name=oidc_name,
+                                      urls=[url for url in urls if url in down_urls],
+                                      csrf=csrf)
+                yield suffix
 
-        r = requests.post(oidc_send_endpoint, timeout=10,
-                          headers={'Authorization': f'Bearer {access_token}'},
-                          json={'version': 'v0',
-                                # Set the outbound message ID to the job ID to avoid resending a
-                                # message if the job fails and is retried after a message was sent.
-                                'outbound_message_id': job_id,
-                                'channel': 'link_notifications',
-                                'to': user_id,
-                                'title': subject,
-                                'body': message,
-                                'link': {'uri': url, 'text': 'Try Link'}})
+            finally:
+                # Stop checking if the client goes away.
+                pool.kill()
 
-        if r.status_code == 202:
-            return  # Success
+        return stream_results()
 
-        elif r.status_code == 400:
-            try:
-                r_json = r.json()
-            except ValueError:
-                r_json = None
+    @app.post('/links/notify')
+    @session_handler.require_session()
+    def notify_bulk():
+        params = parse_params(request.forms.decode(),
+                              urls=string_param('url', strip=True, multi=True, max_length=2000))
+        urls = list(dict.fromkeys(params.get('urls', [])))
+        if not urls:
+            abort(400, 'Please specify some urls.')
+        if len(json.dumps(urls)) > BULK_NOTIFY_MAX_URLS_LENGTH:
+            abort(400, 'Too many urls to be notified about at once.')
+        # Only urls found to be down are offered, but the form can still be sent with any.
+        if not all(is_http_url(url) for url in urls):
+            abort(400, 'Please specify valid http or https urls.')
+
+        # Ask for permission to notify about every url at once, with a single OIDC request.
+        state, nonce, oidc_login_uri = construct_oidc_request('openid', 'offline_access', 'contact',
+                                                              channels=['link_notifications'])
 
-            if r_json and r_json.get('error') == 'outbound_message_id_exists':
-                log.warning('[%(job_id)s] Message already sent.',
-                            {'job_id': job_id})
-                return
+        session_handler.set_oidc_data(state, nonce,
+                                      action='notify_bulk',
+                                      urls=urls)
 
-            log.warning('[%(job_id)s] Message send endpoint returned unexpected 400 Bad Request.',
-                        {'job_id': job_id, 'response_json': r_json})
-            r.raise_for_status()
-            raise Exception('Unexpected 400 Bad Request')
+        redirect(oidc_login_uri)
 
-        elif r.status_code == 403:
-            try:
-                r_json = r.json()
-            except ValueError:
-                r_json = None
+    return app
 
-            if r_json and r_json.get('error') in ('contact_forbidden', 'contact_channel_forbidden'):
-                log.warning('[%(job_id)s] Message send forbidden: %(error)s',
-                            {'job_id': job_id, 'error': r_json['error']})
-                return  # Nothing more we can do.
 
-            log.warning('[%(job_id)s] Message send endpoint returned unexpected 403 Forbidden.',
-                        {'job_id': job_id, 'response_json': r_json})
-            r.raise_for_status()
-            raise Exception('Unexpected 403 Forbidden')
+def run_worker(dao, prober, notifier, delay_multiplier, concurrency,
+               worker_id, lease_seconds, batch_size, wakeup_host, wakeup_port, idle_poll_seconds,
+               schedule_window_seconds, schedule_max_jobs,
+               dispatch, dispatch_concurrency, dispatch_poll_seconds, dispatch_max_attempts,
+               purge_interval_seconds, retention_days, archive, archive_retention_days,
+               purge_chunk_size, purge_chunk_sleep_seconds, record_attempts,
+               host_concurrency, host_min_interval_seconds, host_queue_size,
+               host_failure_threshold, host_open_seconds, connect_timeout_seconds,
+               max_retry_after_seconds,
+               **kwargs):
 
-        else:
-            log.warning('[%(job_id)s] Message send endpoint returned unexpected status code %(status_code)s.',
-                        {'job_id': job_id, 'status_code': r.status_code})
-            r.raise_for_status()
-            raise NotImplementedError(f'Unsupported status code {r.status_code}.')
+    # Jobs are claimed by leasing them to this worker, so multiple workers can share the job table.
+    # The worker ID must be unique to this process.
+    if not worker_id:
+        worker_id = generate_worker_id()
+    log.info('Starting worker %(worker_id)s.', {'worker_id': worker_id})
+
+    # Set whenever the next job may be due sooner than the worker is waiting for - e.g. when the
+    # server adds a job, or this worker requeues one.
+    wakeup = Event()
+    # Set when messages are added to the outbox, so they're sent without waiting for the next poll.
+    dispatch_wakeup = Event()
+
+    # Track upcoming jobs in memory, rather than asking the DB for the next job every iteration.
+    schedule = JobSchedule(dao, schedule_window_seconds, schedule_max_jobs)
+
+    # Finished jobs are buffered and written back in batches, rather than one transaction per job.
+    # Until they're written, they're still leased to this worker, so won't be claimed again.
+    finished_jobs = []
+    flush_finished = Event()
+
+    def finish_job(job, s, retry_job=None, subject=None, body=None):
+        # Messages are recorded in the outbox along with the finished job, and sent separately, so
+        # slow or failing sends don't hold up trying urls.
+        message = None
+        if subject is not None:
+            # Use the job ID as the message ID, so the message isn't sent again if the job is
+            # retried after it was finished, e.g. if the lease expired.
+            message = Message(message_id=job.job_id,
+                              user_id=job.user_id,
+                              url=job.url,
+                              subject=subject,
+                              body=body,
+                              attempts=0,
+                              send_dt=rfc3339.now())
+
+        # Retries reschedule the job in place, so earlier tries are only kept if recorded.
+        attempt = None
+        if record_attempts:
+            attempt = Attempt(job_id=job.job_id,
+                              tries=job.tries,
+                              tried_dt=rfc3339.now(),
+                              status_code=s)
+
+        finished_jobs.append(FinishedJob(job.job_id, retry_job, message, attempt))
+        if len(finished_jobs) >= batch_size:
+            flush_finished.set()
+
+    def write_finished_jobs():
+        batch = finished_jobs[:]
+        del finished_jobs[:]
+        if not batch:
+            return
 
-    def maybe_requeue(job):
+        lost_job_ids = dao.finish_jobs(batch, lease_owner=worker_id)
+        for job_id in lost_job_ids:
+            log.warning('[%(job_id)s] Lease expired before the job was finished.',
+                        {'job_id': job_id})
+
+        for finished_job in batch:
+            if finished_job.job_id in lost_job_ids:
+                continue
+            if finished_job.retry_job is not None:
+                schedule.add(finished_job.retry_job.job_id, finished_job.retry_job.run_dt)
+                wakeup.set()
+            if finished_job.message is not None:
+                dispatch_wakeup.set()
+
+    def maybe_requeue(job, s, retry_after_s=None):
         if job.tries > 1:
             delay = timedelta(seconds=job.delay_s) * delay_multiplier
-            new_job = Job(job_id=generate_id(),
-                          user_id=job.user_id,
-                          status='pending',
-                          run_dt=job.run_dt + delay,
-                          url=job.url,
-                          tries=job.tries - 1,
-                          delay_s=delay.total_seconds())
-            log.info('[%(job_id)s] Couldn\'t load url %(url)s. Retrying. New job: %(new_job_id)s',
-                     {'job_id': job.job_id, 'url': job.url, 'new_job_id': new_job.job_id})
-            dao.finish_job(job.job_id, new_job=new_job)
+            run_dt = job.run_dt + delay
+            # Don't try again before the server asked us to, within reason.
+            if retry_after_s is not None:
+                retry_after = timedelta(seconds=min(retry_after_s, max_retry_after_seconds))
+                run_dt = max(run_dt, rfc3339.now() + retry_after)
+
+            retry_job = job._replace(run_dt=run_dt,
+                                     tries=job.tries - 1,
+                                     delay_s=delay.total_seconds())
+            log.info('[%(job_id)s] Couldn\'t load url %(url)s. Retrying at %(run_dt)s.',
+                     {'job_id': job.job_id, 'url': job.url, 'run_dt': retry_job.run_dt})
+            finish_job(job, s, retry_job=retry_job)
 
         else:
             log.info('[%(job_id)s] Couldn\'t load url %(url)s and out of tries. Notifying user.',
@@ -535,23 +692,22 @@ def run_worker(dao, delay_multiplier, timeout_seconds,
             subject = f'Link still down'
             message = f'Link {job.url} still appears to be be down and all tries have been exhausted. ' + \
                       'No futher attempts to load this link will be made.'
-            send_message(job.job_id, job.user_id, job.url, subject, message)
-            dao.finish_job(job.job_id)
+            finish_job(job, s, subject=subject, body=message)
 
-    def try_url(job):
-        log.info('[%(job_id)s] Trying url %(url)s.',
-                 {'job_id': job.job_id, 'url': job.url})
-
-        try:
-            r = requests.get(job.url, timeout=timeout_seconds)
-            s = r.status_code
-
-        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-            maybe_requeue(job)
+    def finish_tried_job(job, result):
+        if result is INVALID_URL:
+            log.info('[%(job_id)s] Url %(url)s is invalid. Notifying user.',
+                     {'job_id': job.job_id, 'url': job.url})
+            subject = f'Link isn\'t valid'
+            message = f'Link {job.url} isn\'t a valid http or https link, so can\'t be loaded. ' + \
+                      'No futher attempts to load this link will be made.'
+            finish_job(job, None, subject=subject, body=message)
             return
 
-        if 500 <= s < 600:
-            maybe_requeue(job)
+        s = result.status_code if result else None
+        # Too Many Requests is temporary, like a server error.
+        if s is None or 500 <= s < 600 or s == TOO_MANY_REQUESTS:
+            maybe_requeue(job, s, retry_after_s=result.retry_after_s if result else None)
             return
 
         if 400 <= s < 500:
@@ -573,19 +729,200 @@ def run_worker(dao, delay_multiplier, timeout_seconds,
             message = f'Link {job.url} is responding in an unexpected way. ' + \
                       'No futher attempts to load this link will be made.'
 
-        send_message(job.job_id, job.user_id, job.url, subject, message)
-        dao.finish_job(job.job_id)
+        finish_job(job, s, subject=subject, body=message)
 
-    while True:
-        next_job = dao.find_next_job()
+    # Hosts that can't be connected to are treated as down for a while, rather than waiting for
+    # every url on them to time out.
+    host_health = HostHealth(host_failure_threshold, host_open_seconds) \
+        if host_failure_threshold else None
 
-        if next_job:
-            wait_s = (next_job.run_dt - rfc3339.now()).total_seconds()
+    def probe_host_url(host, url):
+        if not is_http_url(url):
+            return INVALID_URL
 
-            if wait_s > 0:
-                time.sleep(min(wait_s, 30))
-            else:
-                try_url(next_job)
+        host_state = host_health.state(host) if host_health else HostHealth.CLOSED
 
-        else:
-            time.sleep(10)
+        if host_state == HostHealth.OPEN:
+            log.info('[Host] Host %(host)s is down. Not trying url %(url)s.',
+                     {'host': host, 'url': url})
+            return None
+
+        if host_state == HostHealth.HALF_OPEN and not can_connect(url, connect_timeout_seconds):
+            log.info('[Host] Host %(host)s is still down. Not trying url %(url)s.',
+                     {'host': host, 'url': url})
+            host_health.record_failure(host)
+            return None
+
+        try:
+            result = prober.probe(url)
+
+        # Cached results were already counted when they were probed, so aren't counted again.
+        except ProbeError as e:
+            if host_health and not e.cached:
+                if e.connect_failed:
+                    host_health.record_failure(host)
+                else:
+                    host_health.record_success(host)
+            return None
+
+        # e.g. the url's host isn't valid, in ways urlsplit doesn't check. Retrying won't help, so
+        # rather than failing the worker, the job is finished.
+        except (requests.exceptions.RequestException, ValueError) as e:
+            log.info('[Host] Invalid url %(url)s: %(error)s', {'url': url, 'error': e})
+            return INVALID_URL
+
+        if host_health and not result.cached:
+            host_health.record_success(host)
+        return result
+
+    def try_url(host, jobs):
+        """Try a url once, and finish every job waiting on it with the result."""
+        url = jobs[0].url
+        for job in jobs:
+            log.info('[%(job_id)s] Trying url %(url)s.',
+                     {'job_id': job.job_id, 'url': url})
+
+        result = probe_host_url(host, url)
+
+        for job in jobs:
+            finish_tried_job(job, result)
+
+    # Jobs are tried concurrently in a bounded pool, so a slow url doesn't hold up every job due
+    # after it. Jobs being tried are leased to this worker, so they aren't picked up again before
+    # they're finished.
+    pool = Pool(concurrency)
+    failures = []
+
+    # Claimed jobs wait here for their host to be ready, so no host is probed too hard at once.
+    # Waiting jobs don't take up a slot in the pool, so jobs for other hosts aren't held up.
+    host_queue = HostQueue(host_concurrency, host_min_interval_seconds)
+    # Set when a host finishes a job, so its next queued job can be started.
+    host_ready = Event()
+
+    def run_jobs(host, jobs):
+        try:
+            try_url(host, jobs)
+        except Exception as e:
+            log.exception('Exception encountered while trying url %(url)s.',
+                          {'url': jobs[0].url})
+            failures.append(e)
+            wakeup.set()
+        finally:
+            host_queue.release(host)
+            host_ready.set()
+
+    def start_queued_jobs():
+        # Leave jobs that have waited on their host for too long to be claimed again once their
+        # lease expires, rather than trying them after it has, when they may be tried twice.
+        for jobs in host_queue.pop_expired(lease_seconds / 2):
+            for job in jobs:
+                log.warning('[%(job_id)s] Waited too long for host to be ready. Skipping.',
+                            {'job_id': job.job_id})
+
+        while pool.free_count() > 0:
+            ready = host_queue.pop_ready()
+            if ready is None:
+                return
+            pool.spawn(run_jobs, *ready)
+
+    def run_writer():
+        while True:
+            flush_finished.wait(timeout=FINISHED_JOBS_FLUSH_INTERVAL_S)
+            flush_finished.clear()
+            try:
+                write_finished_jobs()
+            except Exception as e:
+                log.exception('Exception encountered while finishing jobs.')
+                failures.append(e)
+                wakeup.set()
+                return
+
+    writer = gevent.spawn(run_writer)
+
+    def run_dispatcher_safely():
+        try:
+            run_dispatcher(dao, notifier, worker_id,
+                           concurrency=dispatch_concurrency,
+                           lease_seconds=lease_seconds,
+                           batch_size=batch_size,
+                           poll_seconds=dispatch_poll_seconds,
+                           max_attempts=dispatch_max_attempts,
+                           wakeup=dispatch_wakeup)
+        except Exception as e:
+            log.exception('Exception encountered while sending messages.')
+            failures.append(e)
+            wakeup.set()
+
+    if dispatch:
+        gevent.spawn(run_dispatcher_safely)
+
+    if purge_interval_seconds:
+        gevent.spawn(run_purger, dao, purge_interval_seconds,
+                     retention_days=retention_days,
+                     archive=archive,
+                     archive_retention_days=archive_retention_days,
+                     chunk_size=purge_chunk_size,
+                     chunk_sleep_seconds=purge_chunk_sleep_seconds)
+
+    if wakeup_port:
+        wakeup_listener = WakeupListener(wakeup_host, wakeup_port, wakeup)
+        wakeup_listener.start()
+
+    full_sync_dt = None
+    sync_requested = True
+
+    while True:
+        # Unexpected errors are fatal, as they were before jobs were run concurrently. Let any
+        # other in flight jobs finish first, so they aren't tried again unnecessarily.
+        if failures:
+            pool.join()
+            writer.kill()
+            write_finished_jobs()
+            raise failures[0]
+
+        # Apply backpressure - don't look for more jobs until there's a free slot in the pool.
+        pool.wait_available()
+        start_queued_jobs()
+
+        now_dt = rfc3339.now()
+
+        # Occasionally reload everything, to pick up jobs whose lease expired and any missed
+        # wake ups. Otherwise only load jobs added since the last sync.
+        if full_sync_dt is None or full_sync_dt <= now_dt:
+            schedule.sync(now_dt, full=True)
+            full_sync_dt = now_dt + timedelta(seconds=idle_poll_seconds)
+        elif sync_requested or schedule.needs_sync(now_dt):
+            # Jobs added since the last sync may be due before anything already loaded.
+            schedule.sync(now_dt, new_jobs=sync_requested)
+        sync_requested = False
+
+        # Don't claim more jobs than can be started, or queued while their hosts are busy.
+        limit = min(pool.free_count(), batch_size, host_queue_size - len(host_queue))
+        due_job_ids = schedule.pop_due(now_dt, limit=limit) if limit > 0 else []
+        if due_job_ids:
+            # Another worker may have claimed some of the jobs first, in which case they're skipped.
+            claimed_jobs = dao.claim_jobs(now_dt, worker_id, lease_seconds,
+                                          limit=len(due_job_ids), job_ids=due_job_ids)
+
+            # Many jobs may be waiting on the same url - only try it once for all of them.
+            jobs_by_url = defaultdict(list)
+            for job in claimed_jobs:
+                jobs_by_url[url_hash(job.url)].append(job)
+
+            for jobs in jobs_by_url.values():
+                host_queue.put(url_host(jobs[0].url), jobs)
+            continue
+
+        # Sleep until the next job is due, a queued job's host is ready, or we're woken because a
+        # job may be due sooner. If no more jobs can be queued, only queued jobs matter.
+        wait_s = (full_sync_dt - now_dt).total_seconds()
+        if limit > 0:
+            wait_s = min(wait_s, schedule.wait_s(now_dt))
+        host_wait_s = host_queue.wait_s()
+        if host_wait_s is not None:
+            wait_s = min(wait_s, host_wait_s)
+        if wait_s > 0:
+            gevent.wait([wakeup, host_ready], timeout=wait_s, count=1)
+            sync_requested = wakeup.is_set()
+            wakeup.clear()
+            host_ready.clear()
@@ -0,0 +1,153 @@
+import hashlib
+import logging
+import mimetypes
+import os
+
+from bottle import HTTPResponse, request
+from collections import namedtuple
+
+from utils.compression import ENCODINGS, compress, is_compressible, negotiate_encoding
+
+from .misc import abort, hash_urlsafe
+
+log = logging.getLogger(__name__)
+
+
+STATIC_PATH = 'static'
+
+# Hashed urls change whenever the asset does, so can be cached forever.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Unhashed urls can change with each release, so are only cached briefly.
+CACHE_CONTROL = 'public, max-age=3600'
+
+# Only keep compressed variants that save at least this fraction of the asset's size.
+MIN_COMPRESSION_SAVING = 0.1
+
+HASH_LENGTH = 12
+
+mimetypes.add_type('application/manifest+json', '.webmanifest')
+
+
+Asset = namedtuple('Asset', ['name', 'hashed_name', 'content_type', 'etags', 'bodies'])
+
+
+def content_type_for(name):
+    content_type, _ = mimetypes.guess_type(name)
+    content_type = content_type or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type == 'application/javascript':
+        content_type += '; charset=UTF-8'
+    return content_type
+
+
+def hashed_filename(name, content):
+    """Add a hash of an asset's content to its name, e.g. main.css -> main.<hash>.css"""
+    content_hash = hashlib.blake2b(content).hexdigest()[:HASH_LENGTH]
+    base, ext = os.path.splitext(name)
+    return f'{base}.{content_hash}{ext}'
+
+
+def etag_matches(if_none_match, etags):
+    """Check an If-None-Match header against a set of ETags, comparing weakly as it requires."""
+    if not if_none_match:
+        return False
+
+    for etag in if_none_match.split(','):
+        etag = etag.strip()
+        if etag == '*':
+            return True
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        if etag in etags:
+            return True
+
+    return False
+
+
+class AssetStore(object):
+    """
+    Serves the files in `static_path` from memory.
+
+    Every file is loaded once, and compressible files precompressed with every supported content
+    coding, so serving an asset is just picking which body to send. Each body has its own strong
+    ETag, and conditional requests for the body the client already has get 304 Not Modified.
+
+    Assets are served at both their name, and their name with a hash of their content added, which
+    changes whenever the asset does. Hashed urls are cached forever, so pages should link to
+    assets via `url`.
+    """
+
+    def __init__(self, static_path=STATIC_PATH):
+        self.assets = {}
+        self.assets_by_hashed_name = {}
+
+        total_size = 0
+        for name in sorted(os.listdir(static_path)):
+            path = os.path.join(static_path, name)
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+
+            with open(path, 'rb') as file:
+                asset = self._load_asset(name, file.read())
+
+            self.assets[name] = asset
+            self.assets_by_hashed_name[asset.hashed_name] = asset
+            total_size += sum(len(body) for body in asset.bodies.values())
+
+        log.info('Loaded %(count)s static assets, taking %(size)s bytes.',
+                 {'count': len(self.assets), 'size': total_size})
+
+    @staticmethod
+    def _load_asset(name, content):
+        content_type = content_type_for(name)
+        content_hash = hash_urlsafe(content)
+
+        bodies = {None: content}
+        etags = {None: f'"{content_hash}"'}
+        if is_compressible(content_type):
+            for encoding in ENCODINGS:
+                body = compress(content, encoding)
+                if len(body) <= len(content) * (1 - MIN_COMPRESSION_SAVING):
+                    bodies[encoding] = body
+                    etags[encoding] = f'"{content_hash}-{encoding}"'
+
+        return Asset(name=name,
+                     hashed_name=hashed_filename(name, content),
+                     content_type=content_type,
+                     etags=etags,
+                     bodies=bodies)
+
+    def url(self, name):
+        """Get the hashed url for an asset."""
+        return f'/{self.assets[name].hashed_name}'
+
+    def serve(self, name):
+        """Respond to a request for an asset, by either its name or hashed name."""
+        asset = self.assets_by_hashed_name.get(name)
+        if asset is not None:
+            cache_control = IMMUTABLE_CACHE_CONTROL
+        else:
+            asset = self.assets.get(name)
+            cache_control = CACHE_CONTROL
+        if asset is None:
+            abort(404)
+
+        encoding = None
+        if len(asset.bodies) > 1:
+            encodings = [e for e in asset.bodies if e is not None]
+            encoding = negotiate_encoding(request.headers.get('Accept-Encoding'), encodings)
+
+        headers = {'ETag': asset.etags[encoding],
+                   'Cache-Control': cache_control}
+        if len(asset.bodies) > 1:
+            headers['Vary'] = 'Accept-Encoding'
+
+        if etag_matches(request.headers.get('If-None-Match'), {asset.etags[encoding]}):
+            return HTTPResponse(status=304, headers=headers)
+
+        body = asset.bodies[encoding]
+        headers['Content-Type'] = asset.content_type
+        headers['Content-Length'] = str(len(body))
+        if encoding:
+            headers['Content-Encoding'] = encoding
+
+        return HTTPResponse(body, headers=headers)
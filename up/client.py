@@ -0,0 +1,21 @@
+import requests
+
+from requests.adapters import HTTPAdapter
+
+
+def build_session(pool_hosts, pool_size, pool_block=False):
+    """
+    Build a requests session that keeps connections alive for reuse.
+
+    Connections are pooled per host - up to `pool_hosts` hosts' pools are kept, each holding up to
+    `pool_size` idle connections. If `pool_block` is set, no more than `pool_size` connections are
+    opened to a host at once, and requests wait for a free connection instead.
+    """
+    adapter = HTTPAdapter(pool_connections=pool_hosts,
+                          pool_maxsize=pool_size,
+                          pool_block=pool_block)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
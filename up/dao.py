@@ -1,5 +1,9 @@
+import time
+
 from collections import namedtuple
-from datetime import timezone
+from datetime import date, timedelta, timezone
+
+from .misc import url_hash, watch_key
 
 
 Job = namedtuple('Job', ['job_id',
@@ -10,15 +14,85 @@ Job = namedtuple('Job', ['job_id',
                          'tries',
                          'delay_s'])
 
+# Job columns kept in the archive. Extra columns derived from the job are added to its DB format.
+JOB_ARCHIVE_DB_COLUMNS = (*Job._fields, 'url_hash')
+# Job columns written on insert. The watch key is only needed while the job is pending.
+JOB_DB_COLUMNS = (*JOB_ARCHIVE_DB_COLUMNS, 'watch_key')
+
+# A notification waiting in the outbox to be sent. The message ID is used as the outbound message
+# ID when sending, so a message is never sent twice.
+Message = namedtuple('Message', ['message_id',
+                                 'user_id',
+                                 'url',
+                                 'subject',
+                                 'body',
+                                 'attempts',
+                                 'send_dt'])
+
+# A record of a single try of a job, kept in the optional attempt history.
+Attempt = namedtuple('Attempt', ['job_id',
+                                 'tries',
+                                 'tried_dt',
+                                 'status_code'])
+
+# A job to finish, along with the job to reschedule it as, the message to send about it, and the
+# attempt to record, if any. A retry job keeps the ID of the job it reschedules.
+FinishedJob = namedtuple('FinishedJob', ['job_id', 'retry_job', 'message', 'attempt'])
+
+URL_HASH_BACKFILL_BATCH_SIZE = 1000
+
 
-def build_insert_stmt(table, columns):
+def build_insert_stmt(table, columns, on_duplicate_key_update=None):
     columns_stmt = ', '.join(f'`{c}`' for c in columns)
     values_stmt = ', '.join(f'%({c})s' for c in columns)
-    return f'INSERT INTO `{table}` ({columns_stmt}) VALUES ({values_stmt});'
+    sql = f'INSERT INTO `{table}` ({columns_stmt}) VALUES ({values_stmt})'
+    if on_duplicate_key_update is not None:
+        sql += f' ON DUPLICATE KEY UPDATE {on_duplicate_key_update}'
+    return sql + ';'
+
+
+def build_finish_jobs_stmt(finished_jobs):
+    """
+    Build a single UPDATE finishing every job in `finished_jobs`, returning the SQL and its params.
+
+    Jobs being retried get their new `run_dt`, `tries` and `delay_s`, picked out by `CASE`, and
+    stay pending. Every other job is marked as done, and its watch key cleared so the user can
+    watch the url again. Either way, the job's lease is released.
+    """
+    sql_params = {'job_ids': tuple(f.job_id for f in finished_jobs)}
+
+    retry_jobs = [f.retry_job for f in finished_jobs if f.retry_job is not None]
+    for i, job in enumerate(retry_jobs):
+        sql_params.update({f'job_id_{i}': job.job_id,
+                           f'run_dt_{i}': job.run_dt,
+                           f'tries_{i}': job.tries,
+                           f'delay_s_{i}': job.delay_s})
+
+    def case_stmt(value, default):
+        # `value` is formatted with the index of each retry job, to pick out its params.
+        if not retry_jobs:
+            return default
+        whens = ''.join(f' WHEN %(job_id_{i})s THEN ' + value.format(i=i)
+                        for i in range(len(retry_jobs)))
+        return f'CASE `job_id`{whens} ELSE {default} END'
+
+    sql = 'UPDATE `job`'
+    sql += ' SET `status`=' + case_stmt('\'pending\'', '\'done\'')
+    sql += ', `run_dt`=' + case_stmt('%(run_dt_{i})s', '`run_dt`')
+    sql += ', `tries`=' + case_stmt('%(tries_{i})s', '`tries`')
+    sql += ', `delay_s`=' + case_stmt('%(delay_s_{i})s', '`delay_s`')
+    sql += ', `watch_key`=' + case_stmt('`watch_key`', 'NULL')
+    sql += ', `lease_owner`=NULL, `lease_expire_dt`=NULL'
+    sql += ' WHERE `job_id` IN %(job_ids)s'
+    sql += ';'
+
+    return sql, sql_params
 
 
 def job_to_db_format(job):
-    return job._asdict()
+    return {**job._asdict(),
+            'url_hash': url_hash(job.url),
+            'watch_key': watch_key(job.user_id, job.url) if job.status == 'pending' else None}
 
 
 def job_from_db_format(db_format_job):
@@ -32,6 +106,27 @@ def job_from_db_format(db_format_job):
     return Job(**db_format_job)
 
 
+def message_to_db_format(message):
+    return message._asdict()
+
+
+def message_from_db_format(db_format_message):
+    # Filter DB fields to only those in our namedtuple, in case the DB has more.
+    db_format_message = {k: v
+                         for k, v in db_format_message.items()
+                         if k in Message._fields}
+
+    db_format_message['send_dt'] = db_format_message['send_dt'].replace(tzinfo=timezone.utc)
+
+    return Message(**db_format_message)
+
+
+def next_month(month):
+    if month.month == 12:
+        return month.replace(year=month.year + 1, month=1)
+    return month.replace(month=month.month + 1)
+
+
 def create_db(conn, db_name):
     sql = (
         f'CREATE DATABASE IF NOT EXISTS `{db_name}` '
@@ -67,20 +162,243 @@ class UpDao(object):
                     '   `url` VARCHAR(2000) NOT NULL,'
                     '   `tries` TINYINT UNSIGNED NOT NULL,'
                     '   `delay_s` MEDIUMINT UNSIGNED NOT NULL,'
+                    '   `lease_owner` VARCHAR(191) BINARY NULL,'
+                    '   `lease_expire_dt` DATETIME NULL,'
+                    # Urls are too long to index efficiently, so index a hash of them instead.
+                    '   `url_hash` VARCHAR(32) BINARY NULL,'
+                    # Identifies a user's watch of a url - set only while the job is pending, so a
+                    # user can only have one pending job per url.
+                    '   `watch_key` VARCHAR(32) BINARY NULL,'
                     '   PRIMARY KEY (`job_id`),'
-                    '   KEY `idx_job_status_run_dt` (`status`, `run_dt`)'
+                    '   KEY `idx_job_status_run_dt` (`status`, `run_dt`),'
+                    '   KEY `idx_job_url_hash_status_run_dt` (`url_hash`, `status`, `run_dt`),'
+                    '   UNIQUE KEY `uk_job_watch_key` (`watch_key`)'
                     ');'
                 )
                 cursor.execute(sql)
 
+                # Bring tables created by older versions up to date.
+                self._add_missing_columns(cursor, 'job', [
+                    ('lease_owner', 'VARCHAR(191) BINARY NULL'),
+                    ('lease_expire_dt', 'DATETIME NULL'),
+                    ('url_hash', 'VARCHAR(32) BINARY NULL'),
+                    ('watch_key', 'VARCHAR(32) BINARY NULL'),
+                ])
+                self._add_missing_indexes(cursor, 'job', [
+                    ('idx_job_url_hash_status_run_dt', '(`url_hash`, `status`, `run_dt`)'),
+                ])
+                self._add_missing_indexes(cursor, 'job', [
+                    ('uk_job_watch_key', '(`watch_key`)'),
+                ], unique=True)
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
+        self._backfill_url_hashes()
+        self._backfill_watch_keys()
+
+    def create_outbox_table(self):
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                sql = (
+                    'CREATE TABLE IF NOT EXISTS `outbox` ('
+                    '   `message_id` VARCHAR(100) BINARY NOT NULL,'
+                    '   `user_id` VARCHAR(191) BINARY NOT NULL,'
+                    '   `url` VARCHAR(2000) NOT NULL,'
+                    '   `subject` VARCHAR(255) NOT NULL,'
+                    '   `body` TEXT NOT NULL,'
+                    '   `attempts` TINYINT UNSIGNED NOT NULL,'
+                    '   `send_dt` DATETIME NOT NULL,'
+                    '   `lease_owner` VARCHAR(191) BINARY NULL,'
+                    '   `lease_expire_dt` DATETIME NULL,'
+                    '   PRIMARY KEY (`message_id`),'
+                    '   KEY `idx_outbox_send_dt` (`send_dt`)'
+                    ');'
+                )
+                cursor.execute(sql)
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
+    def create_job_attempt_table(self):
+        """
+        Create the table holding the optional history of each try of a job.
+
+        Retries reschedule the job's row in place, so this is the only record of earlier tries.
+        """
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                sql = (
+                    'CREATE TABLE IF NOT EXISTS `job_attempt` ('
+                    '   `job_id` VARCHAR(100) BINARY NOT NULL,'
+                    '   `tries` TINYINT UNSIGNED NOT NULL,'
+                    '   `tried_dt` DATETIME NOT NULL,'
+                    '   `status_code` SMALLINT UNSIGNED NULL,'
+                    '   PRIMARY KEY (`job_id`, `tries`)'
+                    ');'
+                )
+                cursor.execute(sql)
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
+    def create_job_archive_table(self, partitioned=False):
+        """
+        Create the table done jobs are archived to.
+
+        If `partitioned`, the table is partitioned by month of `run_dt`, so old archived jobs can be
+        dropped a partition at a time rather than deleted row by row. Partitions are added as
+        needed by `add_job_archive_partitions`. Until then rows go in the catch all `p_future`.
+        """
+        sql = (
+            'CREATE TABLE IF NOT EXISTS `job_archive` ('
+            '   `job_id` VARCHAR(100) BINARY NOT NULL,'
+            '   `user_id` VARCHAR(191) BINARY NOT NULL,'
+            '   `status` ENUM(\'pending\', \'done\') NOT NULL,'
+            '   `run_dt` DATETIME NOT NULL,'
+            '   `url` VARCHAR(2000) NOT NULL,'
+            '   `tries` TINYINT UNSIGNED NOT NULL,'
+            '   `delay_s` MEDIUMINT UNSIGNED NOT NULL,'
+            '   `url_hash` VARCHAR(32) BINARY NULL,'
+            # The partitioning column must be part of the primary key.
+            '   PRIMARY KEY (`job_id`, `run_dt`),'
+            '   KEY `idx_job_archive_run_dt` (`run_dt`)'
+            ')'
+        )
+        if partitioned:
+            sql += (
+                ' PARTITION BY RANGE (TO_DAYS(`run_dt`)) ('
+                '   PARTITION `p_future` VALUES LESS THAN MAXVALUE'
+                ')'
+            )
+        sql += ';'
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql)
+
             conn.commit()
 
         finally:
             conn.close()
 
-    def insert_job(self, job):
+    def _backfill_url_hashes(self):
+        """Set the url hash of pending jobs created before url hashes were stored."""
+        select_sql = 'SELECT `job_id`, `url` FROM `job`'
+        select_sql += ' WHERE `status`=\'pending\' AND `url_hash` IS NULL'
+        select_sql += ' LIMIT %(limit)s'
+        select_sql += ';'
+
+        update_sql = 'UPDATE `job`'
+        update_sql += ' SET `url_hash`=%(url_hash)s'
+        update_sql += ' WHERE `job_id`=%(job_id)s'
+        update_sql += ';'
+
+        while True:
+            conn = self.connection_pool.connection()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(select_sql, {'limit': URL_HASH_BACKFILL_BATCH_SIZE})
+                    job_dicts = cursor.fetchall()
+
+                    cursor.executemany(update_sql, [{'job_id': d['job_id'],
+                                                     'url_hash': url_hash(d['url'])}
+                                                    for d in job_dicts])
+
+                conn.commit()
+
+            finally:
+                conn.close()
+
+            if len(job_dicts) < URL_HASH_BACKFILL_BATCH_SIZE:
+                return
+
+    def _backfill_watch_keys(self):
+        """
+        Set the watch key of pending jobs created before watch keys were stored.
+
+        Where a user already has duplicate pending jobs for a url, only the first gets the key - the
+        rest are left without one, and finish as before.
+        """
+        select_sql = 'SELECT `job_id`, `user_id`, `url` FROM `job`'
+        select_sql += ' WHERE `status`=\'pending\' AND `watch_key` IS NULL'
+        select_sql += ' AND `job_id`>%(after_job_id)s'
+        select_sql += ' ORDER BY `job_id` ASC'
+        select_sql += ' LIMIT %(limit)s'
+        select_sql += ';'
+
+        # Ignore duplicate keys, leaving the job without one.
+        update_sql = 'UPDATE IGNORE `job`'
+        update_sql += ' SET `watch_key`=%(watch_key)s'
+        update_sql += ' WHERE `job_id`=%(job_id)s'
+        update_sql += ';'
+
+        after_job_id = ''
+        while True:
+            conn = self.connection_pool.connection()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(select_sql, {'after_job_id': after_job_id,
+                                                'limit': URL_HASH_BACKFILL_BATCH_SIZE})
+                    job_dicts = cursor.fetchall()
+
+                    for d in job_dicts:
+                        cursor.execute(update_sql, {'job_id': d['job_id'],
+                                                    'watch_key': watch_key(d['user_id'], d['url'])})
+
+                conn.commit()
+
+            finally:
+                conn.close()
+
+            if len(job_dicts) < URL_HASH_BACKFILL_BATCH_SIZE:
+                return
+            after_job_id = job_dicts[-1]['job_id']
+
+    def _add_missing_columns(self, cursor, table, columns):
+        sql = 'SELECT `COLUMN_NAME` FROM `information_schema`.`COLUMNS`'
+        sql += ' WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=%(table)s'
+        sql += ';'
+
+        cursor.execute(sql, {'table': table})
+        existing_columns = {r['COLUMN_NAME'] for r in cursor.fetchall()}
+
+        for column, definition in columns:
+            if column not in existing_columns:
+                cursor.execute(f'ALTER TABLE `{table}` ADD COLUMN `{column}` {definition};')
+
+    def _add_missing_indexes(self, cursor, table, indexes, unique=False):
+        sql = 'SELECT DISTINCT `INDEX_NAME` FROM `information_schema`.`STATISTICS`'
+        sql += ' WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=%(table)s'
+        sql += ';'
+
+        cursor.execute(sql, {'table': table})
+        existing_indexes = {r['INDEX_NAME'] for r in cursor.fetchall()}
+
+        index_type = 'UNIQUE INDEX' if unique else 'INDEX'
+        for index, definition in indexes:
+            if index not in existing_indexes:
+                cursor.execute(f'ALTER TABLE `{table}` ADD {index_type} `{index}` {definition};')
+
+    def upsert_job(self, job):
+        """
+        Insert a job, unless the user is already watching its url.
+
+        Users can only have one pending job per url, enforced by the unique watch key. If they
+        already have one, it's left as is rather than adding another.
+        """
         job_dict = job_to_db_format(job)
-        sql = build_insert_stmt('job', job._fields)
+        sql = build_insert_stmt('job', JOB_DB_COLUMNS,
+                                on_duplicate_key_update='`job_id`=`job_id`')
 
         conn = self.connection_pool.connection()
         try:
@@ -92,50 +410,485 @@ class UpDao(object):
         finally:
             conn.close()
 
-    def find_next_job(self):
-        sql = 'SELECT * FROM `job`'
+    def upsert_jobs(self, jobs):
+        """Insert several jobs at once, skipping any for urls their user is already watching."""
+        if not jobs:
+            return
+
+        job_dicts = [job_to_db_format(job) for job in jobs]
+        sql = build_insert_stmt('job', JOB_DB_COLUMNS,
+                                on_duplicate_key_update='`job_id`=`job_id`')
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                # PyMySQL batches this into a single multi-row insert.
+                cursor.executemany(sql, job_dicts)
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
+    def bench_insert_jobs(self, jobs, batch_size):
+        """
+        Time inserting `jobs` into a scratch copy of the job table, `batch_size` jobs per transaction.
+
+        The copy has the same columns and indexes as the job table, and is dropped afterwards.
+        Returns the number of seconds the inserts took.
+        """
+        create_sql = 'CREATE TABLE `job_bench` LIKE `job`;'
+        insert_sql = build_insert_stmt('job_bench', JOB_DB_COLUMNS)
+        drop_sql = 'DROP TABLE IF EXISTS `job_bench`;'
+
+        job_dicts = [job_to_db_format(job) for job in jobs]
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(drop_sql)
+                cursor.execute(create_sql)
+
+            start = time.perf_counter()
+            for i in range(0, len(job_dicts), batch_size):
+                with conn.cursor() as cursor:
+                    cursor.executemany(insert_sql, job_dicts[i:i + batch_size])
+                conn.commit()
+            elapsed_s = time.perf_counter() - start
+
+            with conn.cursor() as cursor:
+                cursor.execute(drop_sql)
+
+        finally:
+            conn.close()
+
+        return elapsed_s
+
+    def find_upcoming_jobs(self, after_dt, until_dt, limit, after_job_id=None):
+        """
+        Find the IDs and run times of pending jobs due after `after_dt` (if set), up to `until_dt`.
+
+        Jobs are ordered by run time then ID, so many jobs due at the same time can be paged through
+        by passing the last job's run time and ID as `after_dt` and `after_job_id`.
+
+        Only indexed columns are selected, so this is served from `idx_job_status_run_dt` alone.
+        """
+        sql = 'SELECT `job_id`, `run_dt` FROM `job`'
         sql += ' WHERE `status`=\'pending\''
-        sql += ' ORDER BY `run_dt` ASC'
-        sql += ' LIMIT 1'
+        if after_dt is not None and after_job_id is not None:
+            sql += ' AND `run_dt`>=%(after_dt)s'
+            sql += ' AND (`run_dt`>%(after_dt)s OR `job_id`>%(after_job_id)s)'
+        elif after_dt is not None:
+            sql += ' AND `run_dt`>%(after_dt)s'
+        sql += ' AND `run_dt`<=%(until_dt)s'
+        sql += ' ORDER BY `run_dt` ASC, `job_id` ASC'
+        sql += ' LIMIT %(limit)s'
         sql += ';'
 
+        sql_params = {'after_dt': after_dt, 'after_job_id': after_job_id,
+                      'until_dt': until_dt, 'limit': limit}
+
         conn = self.connection_pool.connection()
         try:
             with conn.cursor() as cursor:
-                cursor.execute(sql)
+                cursor.execute(sql, sql_params)
                 job_dicts = cursor.fetchall()
-                assert len(job_dicts) in (0, 1)
 
         finally:
             conn.close()
 
-        if job_dicts:
-            return job_from_db_format(job_dicts[0])
-        else:
-            return None
-
-    def finish_job(self, job_id, new_job=None):
-        sql = 'UPDATE `job`'
-        sql += ' SET `status`=\'done\''
-        sql += ' WHERE `job_id`=%(job_id)s'
+        return [(d['job_id'], d['run_dt'].replace(tzinfo=timezone.utc)) for d in job_dicts]
+
+    def find_new_jobs(self, from_job_id, to_job_id, until_dt, limit):
+        """
+        Find the IDs and run times of pending jobs due up to `until_dt`, with IDs in a range.
+
+        Sortable job IDs start with their creation time, so this finds the jobs created in a
+        period. The range is scanned on the primary key, so should be kept short.
+        """
+        sql = 'SELECT `job_id`, `run_dt` FROM `job`'
+        sql += ' WHERE `job_id`>=%(from_job_id)s'
+        sql += ' AND `job_id`<%(to_job_id)s'
+        sql += ' AND `status`=\'pending\''
+        sql += ' AND `run_dt`<=%(until_dt)s'
+        sql += ' ORDER BY `job_id` ASC'
+        sql += ' LIMIT %(limit)s'
         sql += ';'
 
-        sql_params = {'job_id': job_id}
+        sql_params = {'from_job_id': from_job_id, 'to_job_id': to_job_id,
+                      'until_dt': until_dt, 'limit': limit}
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, sql_params)
+                job_dicts = cursor.fetchall()
+
+        finally:
+            conn.close()
+
+        return [(d['job_id'], d['run_dt'].replace(tzinfo=timezone.utc)) for d in job_dicts]
+
+    def claim_jobs(self, now_dt, lease_owner, lease_s, limit, job_ids=None):
+        """
+        Claim up to `limit` due jobs by leasing them to a worker, in a single transaction.
+
+        If `job_ids` is set, only those jobs are considered - any that aren't due or can't be
+        claimed are skipped.
+
+        Jobs with an expired lease can be claimed again, so jobs held by a worker that died are
+        taken back automatically. Rows locked by another worker's claim are skipped rather than
+        waited on, so concurrent claims don't block each other.
+
+        Up to `limit` other due jobs for the same urls as the claimed jobs are claimed too, so each
+        url only needs to be tried once for all the jobs waiting on it.
+        """
+        select_sql = 'SELECT * FROM `job`'
+        select_sql += ' WHERE `status`=\'pending\''
+        if job_ids is not None:
+            select_sql += ' AND `job_id` IN %(claim_job_ids)s'
+        select_sql += ' AND `run_dt`<=%(now_dt)s'
+        select_sql += ' AND (`lease_expire_dt` IS NULL OR `lease_expire_dt`<=%(now_dt)s)'
+        select_sql += ' ORDER BY `run_dt` ASC'
+        select_sql += ' LIMIT %(limit)s'
+        select_sql += ' FOR UPDATE SKIP LOCKED'
+        select_sql += ';'
+
+        same_url_select_sql = 'SELECT * FROM `job`'
+        same_url_select_sql += ' WHERE `url_hash` IN %(url_hashes)s'
+        same_url_select_sql += ' AND `status`=\'pending\''
+        same_url_select_sql += ' AND `run_dt`<=%(now_dt)s'
+        same_url_select_sql += ' AND (`lease_expire_dt` IS NULL OR `lease_expire_dt`<=%(now_dt)s)'
+        same_url_select_sql += ' AND `job_id` NOT IN %(job_ids)s'
+        same_url_select_sql += ' LIMIT %(limit)s'
+        same_url_select_sql += ' FOR UPDATE SKIP LOCKED'
+        same_url_select_sql += ';'
+
+        update_sql = 'UPDATE `job`'
+        update_sql += ' SET `lease_owner`=%(lease_owner)s, `lease_expire_dt`=%(lease_expire_dt)s'
+        update_sql += ' WHERE `job_id` IN %(job_ids)s'
+        update_sql += ';'
+
+        if job_ids is not None and not job_ids:
+            return []
+
+        sql_params = {'now_dt': now_dt,
+                      'claim_job_ids': tuple(job_ids or ()),
+                      'limit': limit,
+                      'lease_owner': lease_owner,
+                      'lease_expire_dt': now_dt + timedelta(seconds=lease_s)}
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(select_sql, sql_params)
+                job_dicts = list(cursor.fetchall())
+
+                if job_dicts:
+                    url_hashes = tuple({d['url_hash'] for d in job_dicts if d['url_hash']})
+                    if url_hashes:
+                        cursor.execute(same_url_select_sql,
+                                       {**sql_params,
+                                        'url_hashes': url_hashes,
+                                        'job_ids': tuple(d['job_id'] for d in job_dicts)})
+                        job_dicts.extend(cursor.fetchall())
+
+                    job_ids = tuple(d['job_id'] for d in job_dicts)
+                    cursor.execute(update_sql, {**sql_params, 'job_ids': job_ids})
+                    assert cursor.rowcount == len(job_ids)
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
+        return [job_from_db_format(d) for d in job_dicts]
+
+    def finish_jobs(self, finished_jobs, lease_owner):
+        """
+        Finish a batch of tried jobs in a single transaction.
+
+        `finished_jobs` is a list of `FinishedJob`s. Jobs with a `retry_job` are rescheduled in
+        place, by updating their row with its `run_dt`, `tries` and `delay_s`. The rest are marked
+        as done. Every job is updated by a single statement, and their messages and attempts are
+        added in the same transaction - so a message is recorded if and only if its job is finished.
+
+        Jobs are only finished if they're still leased to `lease_owner`. The IDs of any jobs that
+        weren't are returned - those jobs, their messages and attempts are left untouched.
+        """
+        if not finished_jobs:
+            return []
+
+        select_sql = 'SELECT `job_id` FROM `job`'
+        select_sql += ' WHERE `job_id` IN %(job_ids)s'
+        select_sql += ' AND `lease_owner`=%(lease_owner)s'
+        select_sql += ' FOR UPDATE'
+        select_sql += ';'
+
+        insert_message_sql = build_insert_stmt('outbox', Message._fields)
+        insert_attempt_sql = build_insert_stmt('job_attempt', Attempt._fields)
+
+        sql_params = {'job_ids': tuple(f.job_id for f in finished_jobs),
+                      'lease_owner': lease_owner}
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(select_sql, sql_params)
+                leased_job_ids = {r['job_id'] for r in cursor.fetchall()}
+                leased_jobs = [f for f in finished_jobs if f.job_id in leased_job_ids]
+
+                if leased_jobs:
+                    update_sql, update_params = build_finish_jobs_stmt(leased_jobs)
+                    cursor.execute(update_sql, update_params)
+                    assert cursor.rowcount == len(leased_jobs)
+
+                message_dicts = [message_to_db_format(f.message)
+                                 for f in leased_jobs
+                                 if f.message is not None]
+                if message_dicts:
+                    # PyMySQL batches this into a single multi-row insert.
+                    cursor.executemany(insert_message_sql, message_dicts)
+
+                attempt_dicts = [f.attempt._asdict()
+                                 for f in leased_jobs
+                                 if f.attempt is not None]
+                if attempt_dicts:
+                    cursor.executemany(insert_attempt_sql, attempt_dicts)
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
+        return [f.job_id for f in finished_jobs if f.job_id not in leased_job_ids]
+
+    def claim_messages(self, now_dt, lease_owner, lease_s, limit):
+        """Claim up to `limit` outbox messages due to be sent, by leasing them to a dispatcher."""
+        select_sql = 'SELECT * FROM `outbox`'
+        select_sql += ' WHERE `send_dt`<=%(now_dt)s'
+        select_sql += ' AND (`lease_expire_dt` IS NULL OR `lease_expire_dt`<=%(now_dt)s)'
+        select_sql += ' ORDER BY `send_dt` ASC'
+        select_sql += ' LIMIT %(limit)s'
+        select_sql += ' FOR UPDATE SKIP LOCKED'
+        select_sql += ';'
+
+        update_sql = 'UPDATE `outbox`'
+        update_sql += ' SET `lease_owner`=%(lease_owner)s, `lease_expire_dt`=%(lease_expire_dt)s'
+        update_sql += ' WHERE `message_id` IN %(message_ids)s'
+        update_sql += ';'
+
+        sql_params = {'now_dt': now_dt,
+                      'limit': limit,
+                      'lease_owner': lease_owner,
+                      'lease_expire_dt': now_dt + timedelta(seconds=lease_s)}
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(select_sql, sql_params)
+                message_dicts = cursor.fetchall()
+
+                if message_dicts:
+                    message_ids = tuple(d['message_id'] for d in message_dicts)
+                    cursor.execute(update_sql, {**sql_params, 'message_ids': message_ids})
+                    assert cursor.rowcount == len(message_ids)
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
+        return [message_from_db_format(d) for d in message_dicts]
+
+    def finish_messages(self, sent_message_ids, retry_messages, lease_owner):
+        """
+        Remove sent messages from the outbox, and release messages to retry, in one transaction.
+
+        `retry_messages` is a list of `Message`s, with their attempts and send_dt updated. Messages
+        no longer leased to `lease_owner` are left untouched.
+        """
+        delete_sql = 'DELETE FROM `outbox`'
+        delete_sql += ' WHERE `message_id` IN %(message_ids)s'
+        delete_sql += ' AND `lease_owner`=%(lease_owner)s'
+        delete_sql += ';'
+
+        retry_sql = 'UPDATE `outbox`'
+        retry_sql += ' SET `attempts`=%(attempts)s, `send_dt`=%(send_dt)s,'
+        retry_sql += ' `lease_owner`=NULL, `lease_expire_dt`=NULL'
+        retry_sql += ' WHERE `message_id`=%(message_id)s'
+        retry_sql += ' AND `lease_owner`=%(lease_owner)s'
+        retry_sql += ';'
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                if sent_message_ids:
+                    cursor.execute(delete_sql, {'message_ids': tuple(sent_message_ids),
+                                                'lease_owner': lease_owner})
+
+                if retry_messages:
+                    cursor.executemany(retry_sql, [{**message_to_db_format(m),
+                                                    'lease_owner': lease_owner}
+                                                   for m in retry_messages])
 
-        if new_job is not None:
-            new_job_dict = job_to_db_format(new_job)
-            new_job_sql = build_insert_stmt('job', new_job._fields)
+            conn.commit()
+
+        finally:
+            conn.close()
+
+    def archive_done_jobs(self, before_dt, limit, archive=True):
+        """
+        Move up to `limit` done jobs due before `before_dt` to the archive, in one transaction.
+
+        If not `archive`, the jobs are just deleted. Their attempt history is deleted either way.
+        Returns the number of jobs moved or deleted. Chunks should be kept small, so locks aren't
+        held for long.
+        """
+        select_sql = 'SELECT `job_id` FROM `job`'
+        select_sql += ' WHERE `status`=\'done\''
+        select_sql += ' AND `run_dt`<%(before_dt)s'
+        select_sql += ' ORDER BY `run_dt` ASC'
+        select_sql += ' LIMIT %(limit)s'
+        select_sql += ' FOR UPDATE SKIP LOCKED'
+        select_sql += ';'
+
+        columns_stmt = ', '.join(f'`{c}`' for c in JOB_ARCHIVE_DB_COLUMNS)
+        archive_sql = f'INSERT INTO `job_archive` ({columns_stmt})'
+        archive_sql += f' SELECT {columns_stmt} FROM `job`'
+        archive_sql += ' WHERE `job_id` IN %(job_ids)s'
+        archive_sql += ';'
+
+        delete_sql = 'DELETE FROM `job`'
+        delete_sql += ' WHERE `job_id` IN %(job_ids)s'
+        delete_sql += ';'
+
+        delete_attempts_sql = 'DELETE FROM `job_attempt`'
+        delete_attempts_sql += ' WHERE `job_id` IN %(job_ids)s'
+        delete_attempts_sql += ';'
+
+        sql_params = {'before_dt': before_dt, 'limit': limit}
+
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(select_sql, sql_params)
+                job_ids = tuple(r['job_id'] for r in cursor.fetchall())
+
+                if job_ids:
+                    if archive:
+                        cursor.execute(archive_sql, {'job_ids': job_ids})
+                    cursor.execute(delete_sql, {'job_ids': job_ids})
+                    cursor.execute(delete_attempts_sql, {'job_ids': job_ids})
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
+        return len(job_ids)
+
+    def delete_archived_jobs(self, before_dt, limit):
+        """Delete up to `limit` archived jobs due before `before_dt`. Returns the number deleted."""
+        sql = 'DELETE FROM `job_archive`'
+        sql += ' WHERE `run_dt`<%(before_dt)s'
+        sql += ' ORDER BY `run_dt` ASC'
+        sql += ' LIMIT %(limit)s'
+        sql += ';'
+
+        sql_params = {'before_dt': before_dt, 'limit': limit}
 
         conn = self.connection_pool.connection()
         try:
             with conn.cursor() as cursor:
                 cursor.execute(sql, sql_params)
-                assert cursor.rowcount == 1
+                deleted = cursor.rowcount
 
-                if new_job is not None:
-                    cursor.execute(new_job_sql, new_job_dict)
+            conn.commit()
+
+        finally:
+            conn.close()
+
+        return deleted
+
+    def _get_job_archive_partitions(self, cursor):
+        """Get the names and upper bounds (as TO_DAYS values) of the archive's month partitions."""
+        sql = 'SELECT `PARTITION_NAME`, `PARTITION_DESCRIPTION` FROM `information_schema`.`PARTITIONS`'
+        sql += ' WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=\'job_archive\''
+        sql += ' AND `PARTITION_NAME` IS NOT NULL'
+        sql += ' ORDER BY `PARTITION_ORDINAL_POSITION` ASC'
+        sql += ';'
+
+        cursor.execute(sql)
+        return [(r['PARTITION_NAME'], r['PARTITION_DESCRIPTION']) for r in cursor.fetchall()]
+
+    def is_job_archive_partitioned(self):
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                return bool(self._get_job_archive_partitions(cursor))
+
+        finally:
+            conn.close()
+
+    def add_job_archive_partitions(self, from_dt, until_dt):
+        """
+        Add month partitions to the archive, covering `from_dt` to `until_dt`.
+
+        Only months after the last existing month partition are added. Older rows fall into the
+        first month partition.
+        """
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                partitions = self._get_job_archive_partitions(cursor)
+                month_partitions = [name for name, _ in partitions if name != 'p_future']
+                if not partitions:
+                    return  # Not partitioned
+
+                month = from_dt.date().replace(day=1)
+                if month_partitions:
+                    last_month = month_partitions[-1]
+                    last_month = date(int(last_month[1:5]), int(last_month[5:7]), 1)
+                    month = max(month, next_month(last_month))
+
+                new_partitions = []
+                while month <= until_dt.date():
+                    new_partitions.append(
+                        f'PARTITION `p{month:%Y%m}` '
+                        f'VALUES LESS THAN (TO_DAYS(\'{next_month(month):%Y-%m-%d}\'))')
+                    month = next_month(month)
+
+                if new_partitions:
+                    new_partitions.append('PARTITION `p_future` VALUES LESS THAN MAXVALUE')
+                    cursor.execute('ALTER TABLE `job_archive` REORGANIZE PARTITION `p_future` INTO '
+                                   f'({", ".join(new_partitions)});')
 
             conn.commit()
 
         finally:
             conn.close()
+
+    def drop_job_archive_partitions(self, before_dt):
+        """Drop archive month partitions that only hold jobs due before `before_dt`."""
+        conn = self.connection_pool.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT TO_DAYS(%(before_dt)s) AS `before_days`;',
+                               {'before_dt': before_dt})
+                before_days = cursor.fetchone()['before_days']
+
+                old_partitions = [name
+                                  for name, less_than in self._get_job_archive_partitions(cursor)
+                                  if name != 'p_future' and int(less_than) <= before_days]
+
+                if old_partitions:
+                    partitions_stmt = ', '.join(f'`{p}`' for p in old_partitions)
+                    cursor.execute(f'ALTER TABLE `job_archive` DROP PARTITION {partitions_stmt};')
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
+        return old_partitions
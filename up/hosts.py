@@ -0,0 +1,153 @@
+import time
+
+from collections import OrderedDict, defaultdict, deque
+
+# How many idle hosts to remember the last start of, before forgetting those past their interval.
+MAX_IDLE_HOSTS = 1024
+# How many failing hosts to track the health of.
+MAX_FAILING_HOSTS = 10000
+
+
+class HostQueue(object):
+    """
+    Queues work per host, so no host is probed too hard at once.
+
+    Work for a host is only started while fewer than `max_per_host` items for it are running, and
+    at least `min_interval_s` seconds after the last item for it was started. Hosts take turns, so
+    a host with a lot of queued work doesn't hold up the rest - other hosts keep full throughput
+    while one is throttled.
+    """
+
+    def __init__(self, max_per_host, min_interval_s):
+        self.max_per_host = max_per_host
+        self.min_interval_s = min_interval_s
+
+        # Host -> queue of (queued time, item). Ordered so hosts take turns.
+        self.queues = OrderedDict()
+        self.running = defaultdict(int)
+        self.next_start_ts = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def put(self, host, item):
+        self.queues.setdefault(host, deque()).append((time.monotonic(), item))
+        self.size += 1
+
+    def _ready_ts(self, host):
+        if self.running.get(host, 0) >= self.max_per_host:
+            return None
+        return self.next_start_ts.get(host, 0)
+
+    def pop_ready(self):
+        """
+        Start the next item for a host that's ready for it, returning the host and item.
+
+        Returns None if no host is ready. The host must be released once the item is done.
+        """
+        now_ts = time.monotonic()
+        for host, queue in self.queues.items():
+            ready_ts = self._ready_ts(host)
+            if ready_ts is None or ready_ts > now_ts:
+                continue
+
+            _, item = queue.popleft()
+            self.size -= 1
+            if queue:
+                # Send the host to the back of the line.
+                self.queues.move_to_end(host)
+            else:
+                del self.queues[host]
+
+            self.running[host] += 1
+            self.next_start_ts[host] = now_ts + self.min_interval_s
+            return host, item
+
+        return None
+
+    def pop_expired(self, max_wait_s):
+        """Remove and return every item that has been queued for more than `max_wait_s`."""
+        cutoff_ts = time.monotonic() - max_wait_s
+        expired = []
+        for host in list(self.queues):
+            queue = self.queues[host]
+            while queue and queue[0][0] < cutoff_ts:
+                expired.append(queue.popleft()[1])
+                self.size -= 1
+            if not queue:
+                del self.queues[host]
+
+        return expired
+
+    def release(self, host):
+        """Mark an item for a host as done, letting the host start another."""
+        self.running[host] -= 1
+        if not self.running[host]:
+            del self.running[host]
+
+        # Forget idle hosts once their interval has passed, so they don't pile up.
+        if len(self.next_start_ts) > MAX_IDLE_HOSTS + len(self.queues) + len(self.running):
+            now_ts = time.monotonic()
+            self.next_start_ts = {h: ts for h, ts in self.next_start_ts.items()
+                                  if ts > now_ts or h in self.queues or h in self.running}
+
+    def wait_s(self):
+        """How long until a queued item may be started, or None if none are waiting on a host."""
+        now_ts = time.monotonic()
+        wait_s = None
+        for host in self.queues:
+            ready_ts = self._ready_ts(host)
+            if ready_ts is None:
+                continue
+            host_wait_s = max(ready_ts - now_ts, 0)
+            wait_s = host_wait_s if wait_s is None else min(wait_s, host_wait_s)
+
+        return wait_s
+
+
+class HostHealth(object):
+    """
+    Circuit breaker tracking which hosts can't be connected to.
+
+    After `failure_threshold` consecutive connection failures, a host's breaker opens, and it's
+    treated as down without trying it for `open_s` seconds. After that, the breaker is half open -
+    a cheap connect check is made before trying the host again, re-opening the breaker if it
+    fails. Any successful connection closes the breaker.
+
+    At most `max_hosts` failing hosts are tracked, forgetting the least recently failed.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, open_s, max_hosts=MAX_FAILING_HOSTS):
+        self.failure_threshold = failure_threshold
+        self.open_s = open_s
+        self.max_hosts = max_hosts
+
+        # Host -> [consecutive failures, time the breaker opened until]
+        self.hosts = OrderedDict()
+
+    def state(self, host):
+        host_health = self.hosts.get(host)
+        if host_health is None or host_health[0] < self.failure_threshold:
+            return self.CLOSED
+
+        if host_health[1] > time.monotonic():
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def record_success(self, host):
+        self.hosts.pop(host, None)
+
+    def record_failure(self, host):
+        host_health = self.hosts.setdefault(host, [0, 0])
+        self.hosts.move_to_end(host)
+        host_health[0] += 1
+        if host_health[0] >= self.failure_threshold:
+            host_health[1] = time.monotonic() + self.open_s
+
+        while len(self.hosts) > self.max_hosts:
+            self.hosts.popitem(last=False)
@@ -1,15 +1,31 @@
 import hashlib
+import os
 import secrets
-import textwrap
+import socket
+import time
 
 from base64 import urlsafe_b64encode
-from bottle import HTTPResponse, response, template
+from bottle import HTTPResponse, response
 from bottle import abort as bottle_abort
+from urllib.parse import urlsplit, urlunsplit
 from utils.security_headers import SecurityHeadersPlugin
 
 ID_BYTES = 16
 HASH_BYTES = 16
 
+SORTABLE_ID_TIMESTAMP_BYTES = 6
+# Crockford's base32 alphabet - sorts in the same order as the values it encodes.
+CROCKFORD_BASE32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class Interrupted(Exception):
+    """
+    Given to callers waiting on a shared in-flight call, if the call was interrupted before it
+    finished, e.g. because the greenlet making it was killed. Waiters should make the call again.
+    """
+
 
 # Have no text by default, unlike the default bottle abort function
 def abort(code=500, text=None):
@@ -20,6 +36,41 @@ def generate_id():
     return secrets.token_urlsafe(ID_BYTES)
 
 
+def generate_sortable_id():
+    """
+    Generate a random ID that sorts by creation time, like a ULID.
+
+    A 48 bit millisecond timestamp is followed by as many random bytes as `generate_id`, so the ID
+    is just as hard to guess. Encoded in Crockford's base32, IDs created later sort after earlier
+    ones, so inserting them appends to an index rather than landing at random places in it.
+    """
+    timestamp_ms = time.time_ns() // 1_000_000
+    return encode_sortable_id(timestamp_ms, secrets.token_bytes(ID_BYTES))
+
+
+def sortable_id_floor(dt):
+    """Get the lowest sortable ID that could have been generated at a time, to find IDs since."""
+    timestamp_ms = int(dt.timestamp() * 1000)
+    return encode_sortable_id(timestamp_ms, bytes(ID_BYTES))
+
+
+def encode_sortable_id(timestamp_ms, random_bytes):
+    id_bytes = timestamp_ms.to_bytes(SORTABLE_ID_TIMESTAMP_BYTES, 'big') + random_bytes
+
+    value = int.from_bytes(id_bytes, 'big')
+    length = -(-len(id_bytes) * 8 // 5)
+    chars = []
+    for _ in range(length):
+        value, digit = divmod(value, 32)
+        chars.append(CROCKFORD_BASE32[digit])
+    return ''.join(reversed(chars))
+
+
+def generate_worker_id():
+    """Generate an ID unique to this process, for leasing jobs and messages to it."""
+    return f'{socket.gethostname()}:{os.getpid()}:{generate_id()[:8]}'
+
+
 def hash_urlsafe(value):
     if isinstance(value, str):
         value = value.encode('utf-8')
@@ -28,9 +79,59 @@ def hash_urlsafe(value):
     return urlsafe_b64encode(hash_bytes).decode('utf-8').replace('=', '')
 
 
-def indent(block, indent=2):
-    """Indent a multi-line text block by a number of spaces"""
-    return textwrap.indent(block.strip(), ' ' * indent)
+def normalize_url(url):
+    """
+    Normalize a url so trivially different forms of the same url compare equal.
+
+    The scheme and host are lowercased, default ports and fragments are dropped, and an empty path
+    becomes "/". Urls that can't be parsed are returned stripped but otherwise unchanged.
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+
+    scheme = parts.scheme.lower()
+
+    netloc = parts.hostname or ''
+    if ':' in netloc:
+        netloc = f'[{netloc}]'  # IPv6 address
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc = f'{netloc}:{port}'
+    if '@' in parts.netloc:
+        userinfo = parts.netloc.rpartition('@')[0]
+        netloc = f'{userinfo}@{netloc}'
+
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+def is_http_url(url):
+    """Check a url is absolute, with an http(s) scheme and a host, so can be probed."""
+    try:
+        parts = urlsplit(url)
+        return parts.scheme.lower() in DEFAULT_PORTS and bool(parts.hostname)
+    except ValueError:
+        return False
+
+
+def url_hash(url):
+    """Hash a normalized url, for indexing and grouping urls that are too long to use directly."""
+    return hash_urlsafe(normalize_url(url))
+
+
+def url_host(url):
+    """Get the lowercased host of a url, or an empty string if it has none or can't be parsed."""
+    try:
+        return urlsplit(normalize_url(url)).hostname or ''
+    except ValueError:
+        return ''
+
+
+def watch_key(user_id, url):
+    """Identify a user's watch of a url, so they can't watch the same url twice at once."""
+    return hash_urlsafe(f'{user_id}\n{url_hash(url)}')
 
 
 def set_headers(r, headers):
@@ -49,11 +150,26 @@ csp_updates = {'img-src': "'self'",
 security_headers = SecurityHeadersPlugin(csp_updates=csp_updates)
 
 
-@security_headers
-def html_default_error_hander(res):
-    if res.status_code == 404:
-        body = template('error_404', error=res)
-    else:
-        body = template('error', error=res)
+def build_html_error_handler(renderer):
+    """
+    Build an error handler rendering HTML error pages.
+
+    Pages that only depend on the status code, rather than a message, are cached by status code. The
+    body of a 404 includes the requested path, so isn't part of the key - otherwise every unknown
+    url would get its own cache entry, evicting the pages worth caching.
+    """
+
+    @security_headers
+    def html_error_handler(res):
+        if res.status_code == 404:
+            name = 'error_404'
+            shows_message = res.body and not res.body.startswith('Not found: ')
+        else:
+            name = 'error'
+            shows_message = res.body and res.status_code < 500
+
+        if shows_message:
+            return renderer.render(name, error=res)
+        return renderer.render_cached(name, key=res.status_code, error=res)
 
-    return body
+    return html_error_handler
@@ -0,0 +1,253 @@
+import gevent
+import logging
+import rfc3339
+
+from datetime import timedelta
+from gevent.event import AsyncResult, Event
+from gevent.pool import Pool
+
+from .misc import Interrupted
+
+log = logging.getLogger(__name__)
+
+
+RETRY_DELAY_S = 60
+MAX_RETRY_DELAY_S = 60 * 60
+
+TOKEN_REFRESH_MARGIN_S = 60
+TOKEN_REFRESH_RETRY_S = 10
+
+
+class TokenManager(object):
+    """
+    Caches a client credentials access token, refreshing it in the background before it expires.
+
+    Concurrent refreshes are collapsed into a single request to the token endpoint, with every
+    caller waiting on its result. If that request is interrupted, e.g. its greenlet is killed, the
+    callers waiting on it refresh again themselves. Hits and misses are counted to see how often
+    callers have to wait for a token.
+    """
+
+    def __init__(self, oidc_session, oidc_token_endpoint, oidc_client_id, oidc_client_secret,
+                 scope, refresh_margin_s=TOKEN_REFRESH_MARGIN_S):
+        self.oidc_session = oidc_session
+        self.oidc_token_endpoint = oidc_token_endpoint
+        self.oidc_client_id = oidc_client_id
+        self.oidc_client_secret = oidc_client_secret
+        self.scope = scope
+        self.refresh_margin_s = refresh_margin_s
+
+        self.token_data = None
+        self.in_flight = None
+        self.refresher = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures}
+
+    def _request_token(self):
+        request_dt = rfc3339.now()
+
+        # Get a client credentials access token.
+        r = self.oidc_session.post(self.oidc_token_endpoint, timeout=10,
+                                   auth=(self.oidc_client_id, self.oidc_client_secret),
+                                   data={'grant_type': 'client_credentials',
+                                         'scope': self.scope})
+
+        if r.status_code != 200:
+            log.warning('OIDC token endpoint returned unexpected status code %(status_code)s.',
+                        {'status_code': r.status_code})
+            r.raise_for_status()
+            raise NotImplementedError(f'Unsupported status code {r.status_code}.')
+
+        r_json = r.json()
+
+        expires_in = timedelta(seconds=r_json['expires_in'])
+        # Don't refresh so early that short lived tokens are refreshed constantly.
+        refresh_margin = min(timedelta(seconds=self.refresh_margin_s), expires_in / 2)
+        return {'access_token': r_json['access_token'],
+                'expire_dt': request_dt + expires_in,
+                'refresh_dt': request_dt + expires_in - refresh_margin}
+
+    def refresh(self):
+        # Only one refresh request at a time - anyone else waits for its result.
+        if self.in_flight is not None:
+            try:
+                return self.in_flight.get()
+            except Interrupted:
+                return self.refresh()
+
+        in_flight = self.in_flight = AsyncResult()
+        try:
+            self.token_data = self._request_token()
+            self.refreshes += 1
+            in_flight.set(self.token_data)
+
+        except Exception as e:
+            self.refresh_failures += 1
+            in_flight.set_exception(e)
+            raise
+
+        except BaseException:
+            # e.g. killed or timed out - don't leave anyone waiting on a refresh that won't finish.
+            in_flight.set_exception(Interrupted())
+            raise
+
+        finally:
+            self.in_flight = None
+
+        log.debug('Refreshed access token. %(hits)s hits, %(misses)s misses so far.',
+                  self.stats())
+        return self.token_data
+
+    def _run_refresher(self):
+        while True:
+            if self.token_data:
+                wait_s = (self.token_data['refresh_dt'] - rfc3339.now()).total_seconds()
+                gevent.sleep(max(wait_s, 0))
+
+            try:
+                self.refresh()
+            except Exception:
+                log.warning('Failed to refresh access token. Retrying in %(retry_s)s seconds.',
+                            {'retry_s': TOKEN_REFRESH_RETRY_S}, exc_info=True)
+                gevent.sleep(TOKEN_REFRESH_RETRY_S)
+
+    def get(self):
+        # Start refreshing in the background once the token is first needed.
+        if self.refresher is None:
+            self.refresher = gevent.spawn(self._run_refresher)
+
+        if self.token_data and rfc3339.now() < self.token_data['expire_dt']:
+            self.hits += 1
+            return self.token_data['access_token']
+
+        self.misses += 1
+        return self.refresh()['access_token']
+
+
+class Notifier(object):
+    """Sends messages to users via the OpenID Connect provider's send endpoint."""
+
+    def __init__(self, oidc_session, token_manager, oidc_send_endpoint):
+        self.oidc_session = oidc_session
+        self.token_manager = token_manager
+        self.oidc_send_endpoint = oidc_send_endpoint
+
+    def send_message(self, message_id, user_id, url, subject, message):
+
+        access_token = self.token_manager.get()
+
+        r = self.oidc_session.post(self.oidc_send_endpoint, timeout=10,
+                                   headers={'Authorization': f'Bearer {access_token}'},
+                                   json={'version': 'v0',
+                                         # Set the outbound message ID to avoid resending a
+                                         # message if sending is retried after it was sent.
+                                         'outbound_message_id': message_id,
+                                         'channel': 'link_notifications',
+                                         'to': user_id,
+                                         'title': subject,
+                                         'body': message,
+                                         'link': {'uri': url, 'text': 'Try Link'}})
+
+        if r.status_code == 202:
+            return  # Success
+
+        elif r.status_code == 400:
+            try:
+                r_json = r.json()
+            except ValueError:
+                r_json = None
+
+            if r_json and r_json.get('error') == 'outbound_message_id_exists':
+                log.warning('[%(message_id)s] Message already sent.',
+                            {'message_id': message_id})
+                return
+
+            log.warning('[%(message_id)s] Message send endpoint returned unexpected 400 Bad Request.',
+                        {'message_id': message_id, 'response_json': r_json})
+            r.raise_for_status()
+            raise Exception('Unexpected 400 Bad Request')
+
+        elif r.status_code == 403:
+            try:
+                r_json = r.json()
+            except ValueError:
+                r_json = None
+
+            if r_json and r_json.get('error') in ('contact_forbidden', 'contact_channel_forbidden'):
+                log.warning('[%(message_id)s] Message send forbidden: %(error)s',
+                            {'message_id': message_id, 'error': r_json['error']})
+                return  # Nothing more we can do.
+
+            log.warning('[%(message_id)s] Message send endpoint returned unexpected 403 Forbidden.',
+                        {'message_id': message_id, 'response_json': r_json})
+            r.raise_for_status()
+            raise Exception('Unexpected 403 Forbidden')
+
+        else:
+            log.warning('[%(message_id)s] Message send endpoint returned unexpected status code %(status_code)s.',
+                        {'message_id': message_id, 'status_code': r.status_code})
+            r.raise_for_status()
+            raise NotImplementedError(f'Unsupported status code {r.status_code}.')
+
+
+def run_dispatcher(dao, notifier, dispatcher_id, concurrency, lease_seconds, batch_size,
+                   poll_seconds, max_attempts, wakeup=None):
+    """
+    Send the messages in the outbox, retrying failed sends with exponential backoff.
+
+    Messages are claimed in batches by leasing them to this dispatcher, and sent concurrently.
+    Messages that still fail after `max_attempts` are dropped. If a `wakeup` event is provided,
+    it can be set to check for new messages without waiting for the next poll.
+    """
+    wakeup = wakeup or Event()
+    pool = Pool(concurrency)
+
+    def send(message):
+        try:
+            notifier.send_message(message.message_id, message.user_id, message.url,
+                                  message.subject, message.body)
+            return message, True
+
+        except Exception:
+            log.warning('[%(message_id)s] Failed to send message on attempt %(attempt)s.',
+                        {'message_id': message.message_id, 'attempt': message.attempts + 1},
+                        exc_info=True)
+            return message, False
+
+    while True:
+        now_dt = rfc3339.now()
+        messages = dao.claim_messages(now_dt, dispatcher_id, lease_seconds, limit=batch_size)
+
+        if not messages:
+            wakeup.wait(timeout=poll_seconds)
+            wakeup.clear()
+            continue
+
+        sent_message_ids = []
+        retry_messages = []
+        for message, sent in pool.imap_unordered(send, messages):
+            attempts = message.attempts + 1
+
+            if sent:
+                sent_message_ids.append(message.message_id)
+
+            elif attempts >= max_attempts:
+                log.error('[%(message_id)s] Failed to send message after %(attempts)s attempts. '
+                          'Giving up.',
+                          {'message_id': message.message_id, 'attempts': attempts})
+                sent_message_ids.append(message.message_id)
+
+            else:
+                delay_s = min(RETRY_DELAY_S * 2 ** message.attempts, MAX_RETRY_DELAY_S)
+                retry_messages.append(message._replace(attempts=attempts,
+                                                       send_dt=now_dt + timedelta(seconds=delay_s)))
+
+        dao.finish_messages(sent_message_ids, retry_messages, lease_owner=dispatcher_id)
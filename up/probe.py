@@ -0,0 +1,337 @@
+import logging
+import requests
+import time
+
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from gevent.event import AsyncResult
+from urllib.parse import urljoin, urlsplit
+from urllib3.exceptions import NewConnectionError
+from urllib3.util import connection
+
+from .misc import DEFAULT_PORTS, Interrupted, normalize_url
+
+# Statuses that may say when to try again in a Retry-After header.
+RETRY_AFTER_STATUSES = (429, 503)
+# Redirects that say the url has moved for good, so can be skipped next time.
+PERMANENT_REDIRECT_STATUSES = (301, 308)
+
+# Bodies of responses without one worth reading, like redirects, are read (up to this size) rather
+# than closing the connection, so it can be reused for the next probe of the host.
+MAX_DRAIN_BYTES = 64 * 1024
+
+# The status of a url, and how many seconds the server asked us to wait before trying again, if any.
+# `cached` is set if the result came from an earlier or concurrent probe, rather than a new one.
+ProbeResult = namedtuple('ProbeResult', ['status_code', 'retry_after_s', 'cached'],
+                         defaults=[False])
+
+log = logging.getLogger(__name__)
+
+
+# Some servers don't support HEAD requests properly, responding with a client error or
+# "Not Implemented" when a GET would succeed. Retry with a GET in those cases - but not when the
+# server asked us to back off, as a GET straight away would only ignore it, and cost more.
+def head_unsupported(status_code):
+    if status_code in RETRY_AFTER_STATUSES:
+        return False
+    return 400 <= status_code < 500 or status_code == 501
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header, either a number of seconds or a date, into seconds from now."""
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    try:
+        retry_dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_dt.tzinfo is None:
+        return None
+
+    return max((retry_dt - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def is_connect_failure(e):
+    """
+    Check if a requests exception means a connection to the host couldn't be made at all, e.g. the
+    host didn't resolve, or refused or timed out the connection. TLS errors and connections dropped
+    once made don't count, as the host is up, if not working properly.
+    """
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, (requests.exceptions.SSLError, requests.exceptions.ProxyError)):
+        return False
+    if not isinstance(e, requests.exceptions.ConnectionError) or not e.args:
+        return False
+
+    # Wraps urllib3's MaxRetryError, giving the reason the last attempt failed.
+    return isinstance(getattr(e.args[0], 'reason', None), NewConnectionError)
+
+
+class ProbeError(Exception):
+    """
+    Raised when a url couldn't be loaded at all, e.g. due to a timeout or connection error.
+
+    `connect_failed` is set if a connection to the host couldn't even be made, suggesting the whole
+    host is down rather than just the url. `cached` is set if the error came from an earlier or
+    concurrent probe, rather than a new one.
+    """
+
+    def __init__(self, message, connect_failed=False, cached=False):
+        super().__init__(message)
+        self.connect_failed = connect_failed
+        self.cached = cached
+
+
+def can_connect(url, timeout_s):
+    """
+    Check if a TCP connection can be made to a url's host - much cheaper than probing it.
+
+    Connections are made the same way urllib3 makes them, so use the same DNS cache as probes, if
+    one is installed.
+    """
+    try:
+        parts = urlsplit(url)
+        port = parts.port or DEFAULT_PORTS.get(parts.scheme.lower())
+        if not parts.hostname or not port:
+            return False
+        with connection.create_connection((parts.hostname, port), timeout=timeout_s):
+            return True
+    except (OSError, ValueError):
+        return False
+
+
+class Prober(object):
+    """
+    Checks the status of urls without downloading their response bodies.
+
+    A HEAD request is tried first, falling back to a streamed GET if the server doesn't seem to
+    support HEAD. GET responses are closed as soon as the status line and headers have been read
+    (and at most `max_body_bytes` of the body), so large bodies are never pulled through. HEAD
+    responses and redirects have no body worth speaking of, so their connections are returned to
+    the session's pool, to be reused for the next probe of the same host.
+
+    Redirects are followed manually. The targets of permanent redirects are remembered (up to
+    `redirect_cache_size` of them, least recently used first out), so later probes of the same url
+    go straight there.
+    """
+
+    def __init__(self, connect_timeout_s, read_timeout_s, max_redirects, max_body_bytes,
+                 session=None, redirect_cache_size=0):
+        self.timeout = (connect_timeout_s, read_timeout_s)
+        self.max_redirects = max_redirects
+        self.max_body_bytes = max_body_bytes
+        self.session = session or requests.Session()
+        self.redirect_cache_size = redirect_cache_size
+
+        # Normalized url -> url it permanently redirects to
+        self.redirects = OrderedDict()
+
+    def _cache_redirect(self, url, location):
+        if not self.redirect_cache_size:
+            return
+
+        key = normalize_url(url)
+        self.redirects[key] = location
+        self.redirects.move_to_end(key)
+        while len(self.redirects) > self.redirect_cache_size:
+            self.redirects.popitem(last=False)
+
+    def _follow_cached_redirects(self, url):
+        # Limit hops, in case redirects have changed into a loop.
+        for _ in range(self.max_redirects):
+            location = self.redirects.get(normalize_url(url))
+            if location is None:
+                break
+            self.redirects.move_to_end(normalize_url(url))
+            url = location
+
+        return url
+
+    @staticmethod
+    def _release(r):
+        """Return a response's connection to the pool, once the rest of its (small) body is read."""
+        try:
+            drained = 0
+            for chunk in r.raw.stream(MAX_DRAIN_BYTES, decode_content=False):
+                drained += len(chunk)
+                if drained > MAX_DRAIN_BYTES:
+                    break
+        except Exception:
+            r.close()
+            return
+
+        if r.raw.closed:
+            r.raw.release_conn()
+        else:
+            # Too much body left to be worth reading.
+            r.close()
+
+    def _request(self, method, url):
+        url = self._follow_cached_redirects(url)
+
+        for _ in range(self.max_redirects + 1):
+            r = self.session.request(method, url, timeout=self.timeout,
+                                     stream=True, allow_redirects=False)
+            try:
+                if r.is_redirect:
+                    location = urljoin(url, r.headers['location'])
+                    if r.status_code in PERMANENT_REDIRECT_STATUSES:
+                        self._cache_redirect(url, location)
+                    url = location
+                    continue
+
+                if method == 'GET' and self.max_body_bytes:
+                    # Reads at most one chunk, translating any errors to requests exceptions.
+                    next(r.iter_content(chunk_size=self.max_body_bytes), None)
+
+                retry_after_s = None
+                if r.status_code in RETRY_AFTER_STATUSES:
+                    retry_after_s = parse_retry_after(r.headers.get('retry-after'))
+
+                return ProbeResult(r.status_code, retry_after_s)
+
+            finally:
+                if method == 'GET' and not r.is_redirect:
+                    # The rest of the body is left unread, so the connection can't be reused.
+                    r.close()
+                else:
+                    self._release(r)
+
+        raise requests.exceptions.TooManyRedirects(
+            f'Exceeded {self.max_redirects} redirects.')
+
+    def probe(self, url):
+        """Get the `ProbeResult` for a url. Raises ProbeError if the url couldn't be loaded."""
+        try:
+            result = self._request('HEAD', url)
+            if head_unsupported(result.status_code):
+                result = self._request('GET', url)
+
+        except (requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.TooManyRedirects) as e:
+            raise ProbeError(str(e), connect_failed=is_connect_failure(e)) from e
+
+        return result
+
+
+class ProbeCache(object):
+    """
+    Caches probe results for a short time, so a url checked by many users at once is only probed
+    once.
+
+    Results are keyed by normalized url, and kept for `ttl_s` seconds. At most `max_size` results
+    are kept, evicting the least recently used. Failures are cached too, as a url that's down is
+    the most likely to be checked repeatedly.
+
+    Concurrent probes of the same url are collapsed into a single probe, with every caller waiting
+    on its result. If that probe is interrupted, e.g. its greenlet is killed, the callers waiting on
+    it probe the url again themselves. Hits, misses and shared probes are counted to see how well
+    the cache works.
+    """
+
+    def __init__(self, prober, ttl_s, max_size):
+        self.prober = prober
+        self.ttl_s = ttl_s
+        self.max_size = max_size
+
+        # Normalized url -> (expire time, probe result, probe error)
+        self.results = OrderedDict()
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.shared
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'shared': self.shared,
+                'evictions': self.evictions,
+                'size': len(self.results),
+                'hit_rate': (self.hits + self.shared) / lookups if lookups else 0}
+
+    def _get(self, key):
+        result = self.results.get(key)
+        if result is None:
+            return None
+
+        if result[0] <= time.monotonic():
+            del self.results[key]
+            return None
+
+        self.results.move_to_end(key)
+        return result
+
+    def _put(self, key, result, error):
+        self.results[key] = (time.monotonic() + self.ttl_s, result, error)
+        self.results.move_to_end(key)
+
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+            self.evictions += 1
+
+    def _probe(self, url, key):
+        # Only one probe of a url at a time - anyone else waits for its result.
+        if key in self.in_flight:
+            self.shared += 1
+            try:
+                return (*self.in_flight[key].get(), False)
+            except Interrupted:
+                return self._probe(url, key)
+
+        self.misses += 1
+        in_flight = self.in_flight[key] = AsyncResult()
+        try:
+            try:
+                result = (self.prober.probe(url), None)
+            except ProbeError as e:
+                result = (None, e)
+
+            self._put(key, *result)
+            in_flight.set(result)
+
+        except Exception as e:
+            in_flight.set_exception(e)
+            raise
+
+        except BaseException:
+            # e.g. killed or timed out - don't leave anyone waiting on a probe that won't finish.
+            in_flight.set_exception(Interrupted())
+            raise
+
+        finally:
+            del self.in_flight[key]
+
+        log.debug('Probed url %(url)s. Probe cache hit rate %(hit_rate).2f so far.',
+                  {'url': url, **self.stats()})
+        return (*result, True)
+
+    def probe(self, url):
+        """
+        Get the `ProbeResult` for a url, like `Prober.probe`, from the cache if possible.
+
+        Results and errors not from a new probe by this caller are marked `cached`, so callers
+        keeping track of what they've seen, like host health, don't count them twice.
+        """
+        key = normalize_url(url)
+
+        cached = self._get(key)
+        if cached is not None:
+            self.hits += 1
+            _, result, error = cached
+            fresh = False
+        else:
+            result, error, fresh = self._probe(url, key)
+
+        if error is not None:
+            raise ProbeError(str(error), connect_failed=error.connect_failed, cached=not fresh)
+        return result if fresh else result._replace(cached=True)
@@ -0,0 +1,74 @@
+import logging
+import rfc3339
+import time
+
+from datetime import timedelta
+
+log = logging.getLogger(__name__)
+
+
+# Make sure partitions exist a little past the current month, so archived jobs never land in the
+# catch all partition.
+PARTITION_LOOKAHEAD = timedelta(days=45)
+
+
+def purge_jobs(dao, retention_days, archive, archive_retention_days,
+               chunk_size, chunk_sleep_seconds):
+    """
+    Remove done jobs older than `retention_days` from the job table, moving them to the archive if
+    `archive` is set. Archived jobs older than `archive_retention_days` (if set) are then dropped.
+
+    Jobs are moved in small chunks, sleeping between each, so locks are never held for long.
+    """
+    now_dt = rfc3339.now()
+    before_dt = now_dt - timedelta(days=retention_days)
+
+    partitioned = archive and dao.is_job_archive_partitioned()
+    if partitioned:
+        dao.add_job_archive_partitions(from_dt=before_dt, until_dt=now_dt + PARTITION_LOOKAHEAD)
+
+    purged = 0
+    while True:
+        count = dao.archive_done_jobs(before_dt, limit=chunk_size, archive=archive)
+        purged += count
+        if count < chunk_size:
+            break
+        time.sleep(chunk_sleep_seconds)
+
+    log.info('%(action)s %(count)s done jobs due before %(before_dt)s.',
+             {'action': 'Archived' if archive else 'Deleted',
+              'count': purged,
+              'before_dt': before_dt})
+
+    if not (archive and archive_retention_days):
+        return
+
+    archive_before_dt = now_dt - timedelta(days=archive_retention_days)
+
+    if partitioned:
+        dropped = dao.drop_job_archive_partitions(archive_before_dt)
+        log.info('Dropped %(count)s archive partitions: %(partitions)s',
+                 {'count': len(dropped), 'partitions': ', '.join(dropped)})
+        return
+
+    deleted = 0
+    while True:
+        count = dao.delete_archived_jobs(archive_before_dt, limit=chunk_size)
+        deleted += count
+        if count < chunk_size:
+            break
+        time.sleep(chunk_sleep_seconds)
+
+    log.info('Deleted %(count)s archived jobs due before %(before_dt)s.',
+             {'count': deleted, 'before_dt': archive_before_dt})
+
+
+def run_purger(dao, interval_seconds, **kwargs):
+    """Purge jobs every `interval_seconds`. Errors are logged, and purging tried again later."""
+    while True:
+        try:
+            purge_jobs(dao, **kwargs)
+        except Exception:
+            log.exception('Exception encountered while purging jobs.')
+
+        time.sleep(interval_seconds)
@@ -0,0 +1,109 @@
+import logging
+import os
+import textwrap
+
+from bottle import SimpleTemplate
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+VIEWS_PATH = 'views'
+BASE_TEMPLATE = 'base.tpl'
+# Pages are placed in the base template's <body>, so are indented to line up with it.
+BASE_INDENT = 4
+
+
+class Renderer(object):
+    """
+    Renders the templates in `views_path` by name.
+
+    Every template is compiled up front, rather than on first use, and pages that rebase onto the
+    base template are indented to fit it once when compiled, rather than every time they're
+    rendered.
+
+    Pages that don't depend on the session can be rendered with `render_cached`, which keeps up to
+    `cache_size` rendered pages keyed by their arguments, evicting the least recently used.
+
+    If a `threadpool` is given, templates are rendered in it, so rendering a large page doesn't
+    hold up every other greenlet on the hub.
+
+    Any `defaults` are available in every template, e.g. helper functions.
+    """
+
+    def __init__(self, views_path=VIEWS_PATH, threadpool=None, cache_size=0, defaults=None):
+        self.threadpool = threadpool
+        self.cache_size = cache_size
+        self.templates = self._compile_templates(views_path, defaults or {})
+
+        # Cache key -> rendered page
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.cache),
+                'hit_rate': self.hits / lookups if lookups else 0}
+
+    @staticmethod
+    def _compile_templates(views_path, defaults):
+        templates = {}
+        for filename in sorted(os.listdir(views_path)):
+            name, ext = os.path.splitext(filename)
+            if ext != '.tpl':
+                continue
+
+            with open(os.path.join(views_path, filename), encoding='utf-8') as file:
+                source = file.read()
+            if source.startswith(f"% rebase('{BASE_TEMPLATE}'"):
+                source = textwrap.indent(source.rstrip(), ' ' * BASE_INDENT)
+
+            template = SimpleTemplate(source=source, name=filename, lookup=[views_path])
+            template.co  # Compile now, rather than on first render.
+            template.defaults = defaults
+            templates[name] = template
+
+        # Share the compiled base template, rather than each page loading its own on first rebase.
+        base_template = templates[os.path.splitext(BASE_TEMPLATE)[0]]
+        for template in templates.values():
+            template.cache[BASE_TEMPLATE] = base_template
+
+        log.info('Compiled %(count)s templates.', {'count': len(templates)})
+        return templates
+
+    def render(self, name, **kwargs):
+        template = self.templates[name]
+        if self.threadpool is None:
+            return template.render(**kwargs)
+
+        return self.threadpool.apply(template.render, (kwargs,))
+
+    def render_cached(self, name, key=None, **kwargs):
+        """
+        Render a template, or get it from the cache if it's been rendered with the same arguments.
+
+        The arguments must be hashable, unless a `key` identifying them is given instead.
+        """
+        if not self.cache_size:
+            return self.render(name, **kwargs)
+
+        key = (name, key if key is not None else tuple(sorted(kwargs.items())))
+        page = self.cache.get(key)
+        if page is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return page
+
+        self.misses += 1
+        page = self.render(name, **kwargs)
+
+        self.cache[key] = page
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        log.debug('Rendered %(name)s. Render cache hit rate %(hit_rate).2f so far.',
+                  {'name': name, **self.stats()})
+        return page
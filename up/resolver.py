@@ -0,0 +1,207 @@
+import ipaddress
+import logging
+import socket
+import time
+
+from collections import OrderedDict
+from gevent.event import AsyncResult
+from urllib3.util import connection
+
+from .misc import Interrupted
+
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:
+    # Fall back to the system resolver, with a fixed TTL.
+    dns = None
+
+log = logging.getLogger(__name__)
+
+
+DNS_LOOKUP_TIMEOUT_S = 5
+
+
+class DnsCache(object):
+    """
+    Caches hostname lookups for as long as their DNS records say they can be.
+
+    Lookups use dnspython to get record TTLs, capped at `max_ttl_s`. If dnspython isn't installed,
+    or can't resolve a name (e.g. it's only in the hosts file), the system resolver is used
+    instead, and its results kept for `fallback_ttl_s`. Failed lookups are kept for
+    `negative_ttl_s`, so names that don't resolve aren't looked up again for every url on them.
+
+    At most `max_size` names are cached, evicting the least recently used. Concurrent lookups of
+    the same name are collapsed into a single lookup, with every caller waiting on its result. If
+    that lookup is interrupted, e.g. its greenlet is killed, the callers waiting on it look the
+    name up again themselves.
+    """
+
+    def __init__(self, max_size, max_ttl_s, fallback_ttl_s, negative_ttl_s):
+        self.max_size = max_size
+        self.max_ttl_s = max_ttl_s
+        self.fallback_ttl_s = fallback_ttl_s
+        self.negative_ttl_s = negative_ttl_s
+        self.resolver = dns.resolver.Resolver() if dns else None
+
+        # Hostname -> (expire time, addresses, lookup error)
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.failures = 0
+        self.lookup_s_total = 0
+        self.lookup_s_max = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.shared
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'shared': self.shared,
+                'failures': self.failures,
+                'size': len(self.entries),
+                'hit_rate': (self.hits + self.shared) / lookups if lookups else 0,
+                'lookup_ms_avg': 1000 * self.lookup_s_total / self.misses if self.misses else 0,
+                'lookup_ms_max': 1000 * self.lookup_s_max}
+
+    def _lookup_dnspython(self, host):
+        # Prefer IPv4 addresses, like most clients.
+        for rdtype in ('A', 'AAAA'):
+            try:
+                answer = self.resolver.resolve(host, rdtype, lifetime=DNS_LOOKUP_TIMEOUT_S)
+            except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+                continue
+
+            ttl_s = min(answer.rrset.ttl, self.max_ttl_s)
+            return [r.address for r in answer], ttl_s
+
+        return None, None
+
+    def _lookup_system(self, host):
+        infos = socket.getaddrinfo(host, None, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        # Keep the resolver's order, without duplicates.
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        return addresses, self.fallback_ttl_s
+
+    def _lookup(self, host):
+        start = time.monotonic()
+        try:
+            addresses = None
+            if self.resolver:
+                try:
+                    addresses, ttl_s = self._lookup_dnspython(host)
+                except dns.exception.DNSException as e:
+                    log.debug('DNS lookup of %(host)s failed: %(error)s', {'host': host, 'error': e})
+
+            if not addresses:
+                addresses, ttl_s = self._lookup_system(host)
+
+            return addresses, None, ttl_s
+
+        except socket.gaierror as e:
+            self.failures += 1
+            return None, e, self.negative_ttl_s
+
+        finally:
+            lookup_s = time.monotonic() - start
+            self.lookup_s_total += lookup_s
+            self.lookup_s_max = max(self.lookup_s_max, lookup_s)
+
+    def _put(self, host, addresses, error, ttl_s):
+        self.entries[host] = (time.monotonic() + ttl_s, addresses, error)
+        self.entries.move_to_end(host)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def _get(self, host):
+        entry = self.entries.get(host)
+        if entry is None:
+            return None
+
+        if entry[0] <= time.monotonic():
+            del self.entries[host]
+            return None
+
+        self.entries.move_to_end(host)
+        return entry
+
+    def resolve(self, host):
+        """Get the addresses for a hostname. Raises socket.gaierror if it doesn't resolve."""
+        host = host.lower()
+
+        entry = self._get(host)
+        if entry is not None:
+            self.hits += 1
+            _, addresses, error = entry
+
+        # Only one lookup of a name at a time - anyone else waits for its result.
+        elif host in self.in_flight:
+            self.shared += 1
+            try:
+                addresses, error = self.in_flight[host].get()
+            except Interrupted:
+                return self.resolve(host)
+
+        else:
+            self.misses += 1
+            in_flight = self.in_flight[host] = AsyncResult()
+            try:
+                addresses, error, ttl_s = self._lookup(host)
+                self._put(host, addresses, error, ttl_s)
+                in_flight.set((addresses, error))
+
+            except Exception as e:
+                in_flight.set_exception(e)
+                raise
+
+            except BaseException:
+                # e.g. killed or timed out - don't leave anyone waiting on a lookup that won't
+                # finish.
+                in_flight.set_exception(Interrupted())
+                raise
+
+            finally:
+                del self.in_flight[host]
+
+            log.debug('Looked up %(host)s. DNS cache hit rate %(hit_rate).2f so far.',
+                      {'host': host, **self.stats()})
+
+        if error is not None:
+            raise socket.gaierror(*error.args)
+        return addresses
+
+
+def is_ip_address(host):
+    try:
+        ipaddress.ip_address(host.strip('[]'))
+        return True
+    except ValueError:
+        return False
+
+
+def install_dns_cache(dns_cache):
+    """
+    Make every connection urllib3 (and so requests) opens look up its host in `dns_cache`.
+
+    Connections are still made by urllib3, just to an address rather than a hostname, so TLS is
+    still checked against the hostname. Each address is tried in turn until one connects.
+    """
+    create_connection = connection.create_connection
+
+    def create_cached_connection(address, *args, **kwargs):
+        host, port = address
+        if is_ip_address(host):
+            return create_connection(address, *args, **kwargs)
+
+        error = None
+        for ip_address in dns_cache.resolve(host):
+            try:
+                return create_connection((ip_address, port), *args, **kwargs)
+            except OSError as e:
+                error = e
+
+        raise error or socket.gaierror(f'No addresses found for {host}.')
+
+    connection.create_connection = create_cached_connection
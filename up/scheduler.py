@@ -0,0 +1,162 @@
+import heapq
+import logging
+
+from datetime import timedelta
+
+from .misc import sortable_id_floor
+
+log = logging.getLogger(__name__)
+
+
+# How far to look around the last check for new jobs, to allow for clock differences between the
+# servers creating jobs and this worker.
+NEW_JOBS_MARGIN = timedelta(seconds=60)
+
+
+class ScheduledJob(object):
+    """Compact heap entry for an upcoming job - only what's needed to know when to claim it."""
+    __slots__ = ('run_ts', 'job_id')
+
+    def __init__(self, run_ts, job_id):
+        self.run_ts = run_ts
+        self.job_id = job_id
+
+    def __lt__(self, other):
+        return (self.run_ts, self.job_id) < (other.run_ts, other.job_id)
+
+
+class JobSchedule(object):
+    """
+    In-memory timer heap of the pending jobs due within a look-ahead window.
+
+    The heap is loaded from the DB incrementally - each sync only fetches jobs due after the high
+    water mark of the last sync, up to the end of the window. The high water mark is a run time and
+    job ID, so jobs due at the same time are never skipped when the heap fills part way through
+    them. A full sync reloads everything, to pick up jobs that were missed, e.g. because their
+    lease expired after they were dropped.
+
+    Jobs added since the last sync may be due before the high water mark, so wouldn't be fetched
+    by an incremental sync. When told there are new jobs, a sync also fetches jobs created since it
+    last looked, going by their sortable IDs.
+
+    The heap only says when jobs may be due - they still have to be claimed before they're run,
+    and jobs that can't be claimed are simply dropped.
+    """
+
+    def __init__(self, dao, window_s, max_jobs):
+        self.dao = dao
+        self.window = timedelta(seconds=window_s)
+        self.max_jobs = max_jobs
+        self.heap = []
+        self.job_ids = set()
+        # All pending jobs due up to this time (as of the last sync) are in the heap - or if the
+        # heap filled, only those up to this time and job ID.
+        self.high_water_dt = None
+        self.high_water_job_id = None
+        # Jobs created up to this time (as of the last sync) have been looked for.
+        self.new_jobs_dt = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def _push(self, job_id, run_dt):
+        if job_id in self.job_ids:
+            return
+
+        heapq.heappush(self.heap, ScheduledJob(run_dt.timestamp(), job_id))
+        self.job_ids.add(job_id)
+
+    def _sync_new_jobs(self, now_dt, limit):
+        from_job_id = sortable_id_floor(self.new_jobs_dt - NEW_JOBS_MARGIN)
+        to_job_id = sortable_id_floor(now_dt + NEW_JOBS_MARGIN)
+        # Jobs due after the high water mark are fetched by the incremental sync anyway.
+        new_jobs = self.dao.find_new_jobs(from_job_id, to_job_id,
+                                          until_dt=self.high_water_dt, limit=limit)
+        for job_id, run_dt in new_jobs:
+            self.add(job_id, run_dt)
+
+        # If there were too many to fetch, look again from the same point next time.
+        if len(new_jobs) < limit:
+            self.new_jobs_dt = now_dt
+
+        log.debug('Synced %(count)s new jobs. %(size)s jobs scheduled.',
+                  {'count': len(new_jobs), 'size': len(self.heap)})
+
+    def sync(self, now_dt, full=False, new_jobs=False):
+        """
+        Load upcoming jobs into the heap. If `new_jobs` is set, also look for jobs created since the
+        last sync that are due before the high water mark.
+        """
+        if full:
+            self.heap = []
+            self.job_ids = set()
+            self.high_water_dt = None
+            self.high_water_job_id = None
+            self.new_jobs_dt = now_dt
+
+        elif new_jobs and self.high_water_dt is not None and len(self.heap) < self.max_jobs:
+            self._sync_new_jobs(now_dt, limit=self.max_jobs - len(self.heap))
+
+        horizon_dt = now_dt + self.window
+        limit = self.max_jobs - len(self.heap)
+        if limit <= 0:
+            return
+
+        upcoming_jobs = self.dao.find_upcoming_jobs(after_dt=self.high_water_dt,
+                                                    after_job_id=self.high_water_job_id,
+                                                    until_dt=horizon_dt,
+                                                    limit=limit)
+        for job_id, run_dt in upcoming_jobs:
+            self._push(job_id, run_dt)
+
+        # If the heap filled up, only jobs up to the last one loaded are known.
+        if len(upcoming_jobs) == limit:
+            self.high_water_job_id, self.high_water_dt = upcoming_jobs[-1]
+        else:
+            self.high_water_dt = horizon_dt
+            self.high_water_job_id = None
+
+        log.debug('Synced %(count)s upcoming jobs. %(size)s jobs scheduled.',
+                  {'count': len(upcoming_jobs), 'size': len(self.heap)})
+
+    def needs_sync(self, now_dt):
+        """Check if the window has moved far enough past the high water mark to sync again."""
+        if len(self.heap) >= self.max_jobs:
+            return False
+
+        return self.high_water_dt is None or self.high_water_dt <= now_dt + self.window / 2
+
+    def add(self, job_id, run_dt):
+        """Add a job added by this worker, if it falls within the synced part of the window."""
+        if self.high_water_dt is None:
+            return
+
+        if self.high_water_job_id is None:
+            synced = run_dt <= self.high_water_dt
+        else:
+            synced = (run_dt, job_id) <= (self.high_water_dt, self.high_water_job_id)
+        if synced:
+            self._push(job_id, run_dt)
+
+    def pop_due(self, now_dt, limit):
+        now_ts = now_dt.timestamp()
+        job_ids = []
+        while self.heap and len(job_ids) < limit and self.heap[0].run_ts <= now_ts:
+            scheduled_job = heapq.heappop(self.heap)
+            self.job_ids.discard(scheduled_job.job_id)
+            job_ids.append(scheduled_job.job_id)
+
+        return job_ids
+
+    def wait_s(self, now_dt):
+        """How long until the next job is due, or the schedule needs syncing again."""
+        wait_s = None
+        if len(self.heap) < self.max_jobs:
+            sync_dt = (self.high_water_dt - self.window / 2) if self.high_water_dt else now_dt
+            wait_s = (sync_dt - now_dt).total_seconds()
+
+        if self.heap:
+            next_s = self.heap[0].run_ts - now_dt.timestamp()
+            wait_s = next_s if wait_s is None else min(wait_s, next_s)
+
+        return max(wait_s, 0)
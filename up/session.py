@@ -3,13 +3,15 @@ import functools
 import json
 import jwt
 import logging
+import time
 
 from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import OrderedDict
 from bottle import request, response, redirect
 from jwt.exceptions import InvalidTokenError, ExpiredSignatureError
 from urllib.parse import urlencode
 
-from .misc import abort, set_headers
+from .misc import abort, hash_urlsafe, set_headers
 
 log = logging.getLogger(__name__)
 
@@ -27,18 +29,79 @@ CACHE_HEADERS = {
 
 
 class TokenDecoder(object):
+    """
+    Verifies and decodes ID tokens.
 
-    def __init__(self, oidc_public_key, oidc_iss, oidc_client_id):
+    The same session token is sent with every request for as long as the session lasts, so the
+    claims of up to `cache_size` verified tokens are cached, keyed by a hash of the token, to avoid
+    checking the RSA signature every time. A cached token is only used until it expires.
+
+    If a `threadpool` is given, signatures are checked in it, so a burst of logins doesn't hold up
+    every other greenlet on the hub.
+    """
+
+    def __init__(self, oidc_public_key, oidc_iss, oidc_client_id, cache_size=0, threadpool=None):
         self.oidc_public_key = oidc_public_key
         self.oidc_iss = oidc_iss
         self.oidc_client_id = oidc_client_id
+        self.cache_size = cache_size
+        self.threadpool = threadpool
+
+        # Token hash -> (expire timestamp, claims)
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.cache)}
+
+    def _get_cached(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+
+        if entry[0] <= time.time():
+            del self.cache[key]
+            return None
+
+        self.cache.move_to_end(key)
+        return entry[1]
+
+    def _cache(self, key, payload):
+        # Tokens without an expiry aren't cached, as they can't be expired from the cache.
+        if 'exp' not in payload:
+            return
+
+        self.cache[key] = (payload['exp'], payload)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
 
     def decode_id_token(self, token):
-        payload = jwt.decode(token, self.oidc_public_key,
-                             algorithms='RS256',
-                             issuer=self.oidc_iss,
-                             audience=self.oidc_client_id)
-        return payload
+        key = None
+        if self.cache_size:
+            key = hash_urlsafe(token)
+            payload = self._get_cached(key)
+            if payload is not None:
+                self.hits += 1
+                return dict(payload)
+            self.misses += 1
+
+        decode_kwargs = {'algorithms': 'RS256',
+                         'issuer': self.oidc_iss,
+                         'audience': self.oidc_client_id}
+        if self.threadpool is None:
+            payload = jwt.decode(token, self.oidc_public_key, **decode_kwargs)
+        else:
+            payload = self.threadpool.apply(jwt.decode, (token, self.oidc_public_key),
+                                            decode_kwargs)
+
+        if key is not None:
+            self._cache(key, payload)
+            log.debug('Verified token. %(hits)s hits, %(misses)s misses so far.', self.stats())
+        return dict(payload)
 
 
 class SessionHandler(object):
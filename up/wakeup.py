@@ -0,0 +1,59 @@
+import logging
+import socket
+
+from gevent.server import DatagramServer
+
+log = logging.getLogger(__name__)
+
+
+WAKEUP_MESSAGE = b'wakeup'
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+class WorkerWaker(object):
+    """
+    Pings workers over UDP to tell them the job table has changed.
+
+    Pings are best effort - workers still poll occasionally in case any are lost.
+    """
+
+    def __init__(self, addresses):
+        self.addresses = [parse_address(a) for a in addresses]
+
+    def wake(self):
+        if not self.addresses:
+            return
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for address in self.addresses:
+                try:
+                    sock.sendto(WAKEUP_MESSAGE, address)
+                except OSError as e:
+                    log.warning('Failed to wake worker at %(host)s:%(port)s: %(error)s',
+                                {'host': address[0], 'port': address[1], 'error': e})
+
+
+class WakeupListener(object):
+    """
+    Listens for UDP pings from WorkerWaker, setting an event when one is received.
+
+    Pings aren't authenticated, so `host` should be an interface only the server can reach.
+    """
+
+    def __init__(self, host, port, event):
+        self.event = event
+        self.server = DatagramServer((host, port), self.handle)
+
+    def handle(self, data, address):
+        if data == WAKEUP_MESSAGE:
+            self.event.set()
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
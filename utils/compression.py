@@ -0,0 +1,272 @@
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    # Only gzip is offered without brotli.
+    brotli = None
+
+
+# In order of preference, when a client accepts more than one equally.
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+# Assets are compressed once, so can take the time to compress as small as possible.
+MAX_LEVELS = {'br': 11, 'gzip': 9}
+# Responses are compressed as they're sent, so trade some size for speed.
+RESPONSE_LEVELS = {'br': 5, 'gzip': 6}
+
+# Smaller bodies gain little from compressing, and may even grow.
+MIN_COMPRESS_SIZE = 1024
+
+# Responses with these status codes have no body, or only part of one.
+NO_COMPRESS_STATUS_CODES = {204, 206, 304}
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/manifest+json',
+    'application/xml',
+    'image/svg+xml',
+    'image/vnd.microsoft.icon',
+    'image/x-icon',
+}
+
+
+def is_compressible(content_type):
+    """Check if a content type is worth compressing, i.e. isn't already compressed."""
+    if not content_type:
+        return False
+
+    mime_type = content_type.split(';', 1)[0].strip().lower()
+    return mime_type.startswith('text/') or mime_type in COMPRESSIBLE_TYPES
+
+
+def parse_accept_encoding(accept_encoding):
+    """Parse an Accept-Encoding header into a dict of content coding -> quality value."""
+    qvalues = {}
+    for entry in (accept_encoding or '').split(','):
+        coding, *params = [part.strip() for part in entry.split(';')]
+        if not coding:
+            continue
+
+        qvalue = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+
+        qvalues[coding.lower()] = qvalue
+
+    return qvalues
+
+
+def negotiate_encoding(accept_encoding, encodings=ENCODINGS):
+    """
+    Pick the content coding to use for a response, from those in `encodings` the client accepts.
+
+    The coding with the highest quality value is used, ties going to the earliest in `encodings`.
+    Returns None if none are accepted, and the response should be sent as is.
+    """
+    qvalues = parse_accept_encoding(accept_encoding)
+    default_qvalue = qvalues.get('*', 0.0)
+
+    best_encoding = None
+    best_qvalue = 0.0
+    for encoding in encodings:
+        qvalue = qvalues.get(encoding, default_qvalue)
+        if qvalue > best_qvalue:
+            best_encoding = encoding
+            best_qvalue = qvalue
+
+    return best_encoding
+
+
+def compress(body, encoding, level=None):
+    """Compress a body with a content coding, at the maximum level if no `level` is given."""
+    level = MAX_LEVELS[encoding] if level is None else level
+
+    if encoding == 'br':
+        return brotli.compress(body, quality=level)
+
+    if encoding == 'gzip':
+        # Fix the timestamp, so the same body always compresses the same way.
+        return gzip.compress(body, compresslevel=level, mtime=0)
+
+    raise ValueError(f'Unsupported content coding {encoding}.')
+
+
+class StreamCompressor(object):
+    """Compresses a body chunk by chunk, flushing each so it can be sent as soon as it's ready."""
+
+    def __init__(self, encoding, level=None):
+        self.encoding = encoding
+        level = MAX_LEVELS[encoding] if level is None else level
+
+        if encoding == 'br':
+            self.compressor = brotli.Compressor(quality=level)
+        elif encoding == 'gzip':
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            raise ValueError(f'Unsupported content coding {encoding}.')
+
+    def compress(self, chunk):
+        if self.encoding == 'br':
+            return self.compressor.process(chunk) + self.compressor.flush()
+
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self.compressor.finish()
+
+        return self.compressor.flush()
+
+
+class CompressedBody(object):
+    """Wraps a WSGI response body, compressing each chunk as it's sent."""
+
+    def __init__(self, body, compressor):
+        self.body = body
+        self.compressor = compressor
+
+    def __iter__(self):
+        for chunk in self.body:
+            if chunk:
+                yield self.compressor.compress(chunk)
+
+        yield self.compressor.finish()
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
+def get_header(headers, name):
+    name = name.lower()
+    for header_name, value in headers:
+        if header_name.lower() == name:
+            return value
+    return None
+
+
+def set_header(headers, name, value):
+    lower_name = name.lower()
+    headers = [(n, v) for n, v in headers if n.lower() != lower_name]
+    headers.append((name, value))
+    return headers
+
+
+def add_vary(headers):
+    vary = get_header(headers, 'Vary')
+    if not vary:
+        return set_header(headers, 'Vary', 'Accept-Encoding')
+
+    fields = [field.strip().lower() for field in vary.split(',')]
+    if '*' in fields or 'accept-encoding' in fields:
+        return headers
+    return set_header(headers, 'Vary', f'{vary}, Accept-Encoding')
+
+
+def encoded_headers(headers, encoding):
+    headers = set_header(headers, 'Content-Encoding', encoding)
+
+    # The encoded body differs from the original, so can't share a strong ETag with it.
+    etag = get_header(headers, 'ETag')
+    if etag and not etag.startswith('W/'):
+        headers = set_header(headers, 'ETag', f'W/{etag}')
+    return headers
+
+
+def is_compressible_response(status, headers, min_size):
+    """Check if a response is worth compressing, whatever encodings the client accepts."""
+    status_code = int(status.partition(' ')[0])
+    if status_code < 200 or status_code in NO_COMPRESS_STATUS_CODES:
+        return False
+
+    if get_header(headers, 'Content-Encoding'):
+        return False  # Already compressed
+
+    if 'no-transform' in (get_header(headers, 'Cache-Control') or '').lower():
+        return False
+
+    if not is_compressible(get_header(headers, 'Content-Type')):
+        return False
+
+    content_length = get_header(headers, 'Content-Length')
+    return content_length is None or int(content_length) >= min_size
+
+
+def wsgi_compression_middleware(application, min_size=MIN_COMPRESS_SIZE, levels=RESPONSE_LEVELS):
+    """
+    WSGI middleware to compress responses with the best content coding the client accepts.
+
+    Only compressible content types of at least `min_size` bytes are compressed, and never
+    responses that are already encoded. Bodies with a Content-Length are compressed whole, so the
+    compressed length can be set. Bodies without one are streamed, compressing each chunk as it's
+    sent. Every response that could be compressed gets `Vary: Accept-Encoding`, whether it is or
+    not, so caches keep compressed and uncompressed responses apart.
+    """
+
+    def wsgi_compression_wrapper(environ, start_response):
+        accept_encoding = environ.get('HTTP_ACCEPT_ENCODING')
+        is_head = environ.get('REQUEST_METHOD') == 'HEAD'
+
+        # A buffered response that's yet to be started - status, headers, exc_info and encoding
+        buffered = []
+        # The compressor, for a streamed response
+        streaming = []
+        # Anything written via write(), before a buffered response's body
+        written = []
+
+        def buffered_write(data):
+            written.append(data)
+
+        def custom_start_response(status, response_headers, exc_info=None):
+            if not is_compressible_response(status, response_headers, min_size):
+                return start_response(status, response_headers, exc_info)
+
+            response_headers = add_vary(response_headers)
+            # HEAD responses have no body to compress, but should have the same headers as GETs.
+            encoding = None if is_head else negotiate_encoding(accept_encoding)
+            if encoding is None:
+                return start_response(status, response_headers, exc_info)
+
+            if get_header(response_headers, 'Content-Length') is not None:
+                # Start the response once the body has been compressed, and its length is known.
+                buffered[:] = [(status, response_headers, exc_info, encoding)]
+                return buffered_write
+
+            compressor = StreamCompressor(encoding, levels[encoding])
+            streaming[:] = [compressor]
+            write = start_response(status, encoded_headers(response_headers, encoding), exc_info)
+            return lambda data: write(compressor.compress(data))
+
+        body = application(environ, custom_start_response)
+
+        if streaming:
+            return CompressedBody(body, streaming[0])
+
+        if not buffered:
+            return body
+
+        status, response_headers, exc_info, encoding = buffered[0]
+        try:
+            data = b''.join(written + list(body))
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+        compressed = compress(data, encoding, levels[encoding])
+        if len(compressed) < len(data):
+            data = compressed
+            response_headers = encoded_headers(response_headers, encoding)
+        response_headers = set_header(response_headers, 'Content-Length', str(len(data)))
+
+        start_response(status, response_headers, exc_info)
+        return [data]
+
+    return wsgi_compression_wrapper
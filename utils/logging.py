@@ -6,6 +6,27 @@ REQUEST_LOG_FORMAT = '%(remote_address)s %(request_protocol)s %(request_method)s
 REQUEST_ERROR_LOG_FORMAT = '%(remote_address)s %(request_protocol)s %(request_method)s %(request_path)s'
 
 
+class LoggedBody(object):
+    """Wraps a WSGI response body, counting its length and calling `on_close` with it when done."""
+
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+        self.length = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.length += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close(self.length)
+
+
 def wsgi_log_middleware(application, request_logger=None):
     """WSGI middleware to provide structured logging for requests."""
 
@@ -52,21 +73,24 @@ def wsgi_log_middleware(application, request_logger=None):
 
             return retval
 
-        retval = application(environ, custom_start_response)
+        def log_request(body_length):
+            # NOTE: This won't include data written via the write() function
+            #       returned by start_response() if no `content-length` header
+            #       was provided.
+            content_length = content_lengths[-1] if content_lengths else body_length
 
-        # NOTE: This won't include data written via the write() function
-        #       returned by start_response() if no `content-length` header
-        #       was provided.
-        content_length = content_lengths[-1] if content_lengths else len(b''.join(retval))
+            log_vals.update({
+                'status_code': status_codes[-1],
+                'elapsed_time': int((perf_counter() - start) * 1000),
+                'content_length': content_length,
+            })
+            request_logger.info(REQUEST_LOG_FORMAT, log_vals)
 
-        log_vals.update({
-            'status_code': status_codes[-1],
-            'elapsed_time': int((perf_counter() - start) * 1000),
-            'content_length': content_length,
-        })
-        request_logger.info(REQUEST_LOG_FORMAT, log_vals)
+        retval = application(environ, custom_start_response)
 
-        return retval
+        # Log once the body has been sent, rather than consuming it here, so streamed responses
+        # are still streamed.
+        return LoggedBody(retval, log_request)
 
     return wsgi_log_wrapper
 
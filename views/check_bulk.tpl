@@ -0,0 +1,21 @@
+% rebase('base.tpl', title='up? - Links Checked')
+<main>
+  <div class="header">
+    <span class="spacer"></span>
+    <a class="buttonLike" href="/logout">Log Out</a>
+  </div>
+  <span class="spacer"></span>
+  <div class="content">
+    <h1>up?</h1>
+    <div class="section">
+      <p>Checking {{count}} link{{'s' if count > 1 else ''}}...</p>
+    </div>
+    <div class="section results">
+{{!results}}
+    </div>
+  </div>
+  <span class="spacer"></span>
+  <div class="linkRow">
+    <a href="/links">Got more links?</a>
+  </div>
+</main>
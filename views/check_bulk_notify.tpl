@@ -0,0 +1,12 @@
+% if urls:
+<form class="section" action="/links/notify" method="POST">
+  <input type="hidden" name="csrf" value="{{csrf}}">
+  % for url in urls:
+  <input type="hidden" name="url" value="{{url}}">
+  % end
+  <p>Should we notify you via {{oidc_name}} when the down links are back up?</p>
+  <button class="mainButton">Notify Me via {{oidc_name}}</button>
+</form>
+% else:
+<p>None of those links seem to be down.</p>
+% end
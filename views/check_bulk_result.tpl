@@ -0,0 +1,15 @@
+<%
+status_text = {
+  'up': 'seems to be up',
+  'down': 'does seem to be down',
+  'client_error': 'is responding with a client error',
+}.get(status, 'is responding in an unexpected way')
+%>
+<p class="{{status}}">
+  % if status == 'invalid':
+  {{url}} isn't a valid link.
+  % else:
+  <a href="{{url}}" target="_blank" rel="noopener noreferrer">{{url}}</a>
+  {{status_text}}.
+  % end
+</p>
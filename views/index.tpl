@@ -20,6 +20,9 @@
       <input type="url" name="url" autocomplete="url" placeholder="Link URL" required>
       <button class="mainButton">Check Link</button>
     </form>
+    <div class="linkRow">
+      <a href="/links">Got a few links?</a>
+    </div>
     % else:
     <div class="section">
       <a class="mainButton" href="/login?auto=true">
@@ -0,0 +1,35 @@
+% rebase('base.tpl', title='up? - Check Links')
+<main>
+  <div class="header">
+    <span class="spacer"></span>
+    <a class="buttonLike" href="/logout">Log Out</a>
+  </div>
+  <span class="spacer"></span>
+  <div class="content limitWidth">
+    <h1>up?</h1>
+    % if defined('alert') and alert:
+    <div class="section alert">
+      % if alert == 'insufficient-scope':
+      <p>The Offline Access and Contact permissions are required for notifications</p>
+      % elif alert == 'insufficient-channels':
+      <p>The Link Notifications channel is required for notifications</p>
+      % end
+    </div>
+    % end
+    <div class="section">
+      <p>
+        Got a few links that are down?<br>
+        Check up to {{max_urls}} at once.
+      </p>
+    </div>
+    <form class="section" action="/links" method="POST">
+      <input type="hidden" name="csrf" value="{{csrf}}">
+      <textarea name="urls" placeholder="Link URLs, one per line" required></textarea>
+      <button class="mainButton">Check Links</button>
+    </form>
+  </div>
+  <span class="spacer"></span>
+  <div class="linkRow">
+    <a href="/">Only got one link?</a>
+  </div>
+</main>
@@ -0,0 +1,25 @@
+% rebase('base.tpl', title='up? - Links Submitted')
+<main>
+  <div class="header">
+    <span class="spacer"></span>
+    <a class="buttonLike" href="/logout">Log Out</a>
+  </div>
+  <span class="spacer"></span>
+  <div class="content">
+    <h1>up?</h1>
+    <div class="section">
+      <p>
+        We'll send you a message on {{oidc_name}} when each of these links is up.
+      </p>
+    </div>
+    <div class="section results">
+      % for url in urls:
+      <p><a href="{{url}}" target="_blank" rel="noopener noreferrer">{{url}}</a></p>
+      % end
+    </div>
+  </div>
+  <span class="spacer"></span>
+  <div class="linkRow">
+    <a href="/links">Got more links?</a>
+  </div>
+</main>